@@ -1,2 +1,5 @@
 from .base import BaseAgent
 from .openai_agent import OpenAIAgent
+from .async_openai_agent import AsyncOpenAIAgent
+from .context import ContextWindow
+from .cache import ResponseCache
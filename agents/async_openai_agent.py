@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import threading
+import weakref
+from typing import Callable, Dict, Tuple
+
+import backoff
+import httpx
+from openai import AsyncOpenAI
+
+from .openai_agent import CONTINUE_FINAL_MESSAGE, RETRY_ERRORS, OpenAIAgent, StreamCutter
+
+logger = logging.getLogger("agent_eval")
+
+
+class LoopBoundClient:
+    """Stands in for an AsyncOpenAI client and builds the real one per event loop.
+
+    An httpx.AsyncClient only works on the loop it first ran on, while agents
+    and endpoint pools outlive a `run_async` loop, e.g. across the runs of
+    mc_orchestrator. Attribute access goes to the client of the running loop.
+    """
+
+    def __init__(self, make: Callable[[], AsyncOpenAI]):
+        self.make = make
+        self._clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def current(self) -> AsyncOpenAI:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._clients:
+                self._clients[loop] = self.make()
+            return self._clients[loop]
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+class AsyncOpenAIAgent(OpenAIAgent):
+    """OpenAIAgent whose calls are coroutines.
+
+    One agent can serve many episodes awaiting completions on the same event
+    loop. All agents talking to the same server from the same loop share one
+    HTTP connection pool with keep-alive, sized by `max_connections` in the
+    config, and every request is bounded by `request_timeout` seconds.
+    """
+
+    # per event loop, the connection pool of each (server, limits)
+    _http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, httpx.AsyncClient]]" = (
+        weakref.WeakKeyDictionary()
+    )
+    _http_clients_lock = threading.Lock()
+
+    @classmethod
+    def http_client(cls, key: Tuple) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with cls._http_clients_lock:
+            clients = cls._http_clients.setdefault(loop, {})
+            if key not in clients:
+                clients[key] = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=key[1],
+                        max_keepalive_connections=key[1],
+                        keepalive_expiry=key[2],
+                    ),
+                )
+            return clients[key]
+
+    @classmethod
+    async def close_http_clients(cls) -> None:
+        """Close the connection pools of the running loop; call before the loop is closed."""
+        with cls._http_clients_lock:
+            clients = cls._http_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+    def make_client(self, base_url, api_key):
+        key = (
+            base_url,
+            self.config.get("max_connections", 256),
+            self.config.get("keepalive_expiry", 60.0),
+        )
+        return LoopBoundClient(lambda: AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            http_client=self.http_client(key),
+            # retries are done by backoff below, once per request
+            max_retries=0,
+        ))
+
+    async def create_completion(self, **kwargs):
+        kwargs["timeout"] = self.config.get("request_timeout", 300.0)
+        with self.request_client() as client:
+            return await client.chat.completions.create(**kwargs)
+
+    async def stream_completion(self, **kwargs) -> StreamCutter:
+        kwargs["timeout"] = self.config.get("request_timeout", 300.0)
+        cutter = StreamCutter()
+        with self.request_client() as client:
+            stream = await client.chat.completions.create(**kwargs)
+            try:
+                async for chunk in stream:
+                    if cutter.feed(chunk):
+                        break
+            finally:
+                await stream.close()
+        return cutter
+
+    async def complete(self, messages, **extra) -> str:
+        request = self.build_request(messages, **extra)
+        key = self.cache_key(request)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.last_usage = None
+                self.last_stream = None
+                return cached
+
+        # `last_usage` is set and returned without yielding to the event loop,
+        # so the awaiting episode reads its own usage
+        if request.get("stream"):
+            return self.finish_stream(await self.stream_completion(**request), request, key)
+        response = await self.create_completion(**request)
+        return self.finish_completion(response, key)
+
+    @backoff.on_exception(backoff.fibo, RETRY_ERRORS)
+    async def __call__(self, messages) -> str:
+        return await self.complete(messages)
+
+    async def call_with_workflow(self, messages) -> str:
+        # the workflow is read before the first await, so episodes sharing
+        # this agent cannot swap it underneath each other
+        return await self.complete(
+            self.workflow_messages(messages),
+            extra_body=CONTINUE_FINAL_MESSAGE,
+        )
@@ -13,6 +13,10 @@ class BaseAgent(ABC):
         logger.debug(f"Initialized {self.__class__.__name__} with config: {config}")
         # The agent should not generate observations or expert feedback
         self.stop_words = ["\nObservation:", "\nTask:", "\n---"]
+        # token usage reported for the last completion, if the backend returns it
+        self.last_usage = None
+        # early-stop details of the last streamed completion
+        self.last_stream = None
 
     @abstractmethod
     def __call__(self) -> str:
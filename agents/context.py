@@ -0,0 +1,107 @@
+from typing import Any, Callable, Dict, List
+
+from utils.datatypes import State
+
+
+class ContextWindow:
+    """Fits the history of one episode into a token budget before each agent call.
+
+    The first `n_pinned` messages (instruction and ICL examples) and the last
+    `keep_recent` messages are always sent as they are. If the prompt is over
+    budget, older observations are cut to their first line, oldest first, and
+    if that is not enough, whole old turns are dropped. `state.history` itself
+    is never modified; what was cut is recorded in `state.context`.
+    """
+
+    elided_suffix = " [...]"
+
+    def __init__(
+        self,
+        budget: int,
+        count_tokens: Callable[[str], int],
+        n_pinned: int,
+        keep_recent: int = 6,
+        message_overhead: int = 4,
+        summary_chars: int = 100,
+    ):
+        self.budget = budget
+        self.count_tokens = count_tokens
+        self.n_pinned = n_pinned
+        self.keep_recent = keep_recent
+        # role markers and separators the chat template adds per message
+        self.message_overhead = message_overhead
+        self.summary_chars = summary_chars
+        # token counts of the messages seen so far; the history only grows
+        self._counts: List[int] = []
+
+    def _count(self, content: str) -> int:
+        return self.count_tokens(content) + self.message_overhead
+
+    def summarize(self, content: str) -> str:
+        first_line = content.split("\n", 1)[0]
+        if len(first_line) > self.summary_chars:
+            first_line = first_line[:self.summary_chars]
+        if first_line == content:
+            return content
+        return first_line + self.elided_suffix
+
+    def build(self, state: State) -> List[Dict[str, Any]]:
+        history = state.history
+        for message in history[len(self._counts):]:
+            self._counts.append(self._count(message["content"]))
+
+        total = sum(self._counts)
+        stats = self._stats(state)
+        stats["max_prompt_tokens"] = max(stats["max_prompt_tokens"], total)
+        if total <= self.budget:
+            return history
+
+        messages = list(history)
+        counts = list(self._counts)
+        sent = total
+        editable_end = max(self.n_pinned, len(history) - self.keep_recent)
+
+        elided = 0
+        for i in range(self.n_pinned, editable_end):
+            if sent <= self.budget:
+                break
+            if messages[i]["role"] != "user":
+                continue
+            short = self.summarize(messages[i]["content"])
+            if short == messages[i]["content"]:
+                continue
+            new_count = self._count(short)
+            sent -= counts[i] - new_count
+            counts[i] = new_count
+            messages[i] = {**messages[i], "content": short}
+            elided += 1
+
+        # drop whole (assistant, observation) turns so roles keep alternating
+        drop_end = self.n_pinned
+        while sent > self.budget and drop_end + 2 <= editable_end:
+            sent -= counts[drop_end] + counts[drop_end + 1]
+            drop_end += 2
+        dropped = drop_end - self.n_pinned
+        messages = messages[:self.n_pinned] + messages[drop_end:]
+
+        stats["truncated_steps"] += 1
+        stats["tokens_saved"] += total - sent
+        stats["steps"].append({
+            "step": state.steps,
+            "prompt_tokens": total,
+            "sent_tokens": sent,
+            "elided_messages": elided,
+            "dropped_messages": dropped,
+        })
+        return messages
+
+    def _stats(self, state: State) -> Dict[str, Any]:
+        if state.context is None:
+            state.context = {
+                "budget": self.budget,
+                "max_prompt_tokens": 0,
+                "truncated_steps": 0,
+                "tokens_saved": 0,
+                "steps": [],
+            }
+        return state.context
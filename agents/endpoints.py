@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import openai
+from openai import OpenAI
+
+logger = logging.getLogger("agent_eval")
+
+
+class Endpoint:
+    def __init__(self, base_url: str, api_key: str, client_factory: Callable = OpenAI):
+        self.base_url = base_url
+        self.client = client_factory(base_url, api_key)
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.served = 0
+
+
+class EndpointPool:
+    """Routes requests over several OpenAI-compatible servers.
+
+    Each request goes to the admitted endpoint with the fewest requests in
+    flight. An endpoint that fails `failure_threshold` times in a row is
+    ejected for `ejection_seconds`; afterwards it is tried again, and a
+    single further failure ejects it again until a request succeeds.
+    """
+
+    # errors that say something about the server rather than about the request
+    endpoint_errors = (
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.InternalServerError,
+    )
+
+    _shared: Dict[Tuple, "EndpointPool"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        api_bases: List[str],
+        api_key: str,
+        client_factory: Callable = OpenAI,
+        failure_threshold: int = 3,
+        ejection_seconds: float = 30.0,
+    ):
+        self.endpoints = [Endpoint(base_url, api_key, client_factory) for base_url in api_bases]
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, api_bases: List[str], api_key: str, client_factory: Callable = OpenAI, **kwargs) -> "EndpointPool":
+        """One pool per endpoint list, so agents of all worker threads balance together."""
+        # sync and async agents need different clients, so they get separate pools
+        key = (tuple(api_bases), api_key, getattr(client_factory, "__qualname__", client_factory))
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(api_bases, api_key, client_factory, **kwargs)
+            return cls._shared[key]
+
+    def acquire(self) -> Endpoint:
+        with self._lock:
+            now = time.monotonic()
+            admitted = [e for e in self.endpoints if e.ejected_until <= now]
+            if admitted:
+                endpoint = min(admitted, key=lambda e: (e.outstanding, e.served))
+            else:
+                # everything is ejected: probe the one that is due first
+                endpoint = min(self.endpoints, key=lambda e: e.ejected_until)
+            endpoint.outstanding += 1
+            endpoint.served += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, ok: bool) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+            if ok:
+                if endpoint.failures >= self.failure_threshold:
+                    logger.info(f"Endpoint {endpoint.base_url} recovered")
+                endpoint.failures = 0
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.failure_threshold:
+                endpoint.ejected_until = time.monotonic() + self.ejection_seconds
+                logger.warning(
+                    f"Ejecting endpoint {endpoint.base_url} for {self.ejection_seconds}s "
+                    f"after {endpoint.failures} consecutive failures"
+                )
+
+    @contextmanager
+    def request(self) -> Iterator[Endpoint]:
+        endpoint = self.acquire()
+        try:
+            yield endpoint
+        except self.endpoint_errors:
+            self.release(endpoint, ok=False)
+            raise
+        except BaseException:
+            self.release(endpoint, ok=True)
+            raise
+        else:
+            self.release(endpoint, ok=True)
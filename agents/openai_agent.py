@@ -1,57 +1,193 @@
 import logging
 import os
+import re
+import threading
+from contextlib import contextmanager
 
 import backoff
 import openai
 from openai import OpenAI
 
 from .base import BaseAgent
+from .cache import ResponseCache
+from .endpoints import EndpointPool
 
 logger = logging.getLogger("agent_eval")
 
+# vLLM options to let the model continue the workflow prefix of the last message
+CONTINUE_FINAL_MESSAGE = {
+    "continue_final_message": True,
+    "add_generation_prompt": False
+}
+
+# a finished action line; nothing after it is needed to parse the action
+ACTION_LINE = re.compile(r"Action:[^\n]*\S[^\n]*\n")
+
+
+class StreamCutter:
+    """Accumulates a streamed completion until it holds a complete action line."""
+
+    def __init__(self):
+        self.text = ""
+        self.chunks = 0
+        self.usage = None
+        self.cut = False
+
+    def feed(self, chunk) -> bool:
+        """Add a chunk; returns True once the stream can be closed."""
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return False
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            return False
+        self.chunks += 1
+        self.text += delta
+        if "\n" in delta:
+            match = ACTION_LINE.search(self.text)
+            if match:
+                self.text = self.text[:match.end() - 1]
+                self.cut = True
+                return True
+        return False
+
+
+# https://platform.openai.com/docs/guides/error-codes/python-library-error-types
+RETRY_ERRORS = (
+    openai.APIError,
+    openai.Timeout,
+    openai.RateLimitError,
+    openai.APIConnectionError,
+)
+
 
 class OpenAIAgent(BaseAgent):
+    # streamed completions of all agents in the process, for the end-of-run log
+    stream_totals = {"streams": 0, "early_stops": 0, "chunks": 0}
+    _stream_totals_lock = threading.Lock()
+
     def __init__(self, config):
         super().__init__(config)
         assert "model_name" in config.keys()
-        self.client = OpenAI(
-            base_url=config.get("api_base", None),
-            api_key=config.get("api_key", os.environ.get("OPENAI_API_KEY")),
+        api_key = config.get("api_key", os.environ.get("OPENAI_API_KEY"))
+        api_base = config.get("api_base", None)
+        self.endpoints = None
+        if isinstance(api_base, list):
+            # several servers of the same model, balanced by outstanding requests
+            self.endpoints = EndpointPool.shared(
+                api_base,
+                api_key,
+                client_factory=self.make_client,
+                failure_threshold=config.get("endpoint_failure_threshold", 3),
+                ejection_seconds=config.get("endpoint_ejection_seconds", 30.0),
+            )
+        else:
+            self.client = self.make_client(api_base, api_key)
+
+        self.cache = None
+        if config.get("cache_path"):
+            self.cache = ResponseCache.shared(
+                config["cache_path"],
+                max_size_mb=config.get("cache_max_size_mb", 1024),
+            )
+
+    def make_client(self, base_url, api_key):
+        return OpenAI(
+            base_url=base_url,
+            api_key=api_key,
         )
 
-    @backoff.on_exception(
-        backoff.fibo,
-        # https://platform.openai.com/docs/guides/error-codes/python-library-error-types
-        (
-            openai.APIError,
-            openai.Timeout,
-            openai.RateLimitError,
-            openai.APIConnectionError,
-        ),
-    )
-    def __call__(self, messages) -> str:
-        # Prepend the prompt with the system message
-        response = self.client.chat.completions.create(
+    @contextmanager
+    def request_client(self):
+        if self.endpoints is None:
+            yield self.client
+            return
+        with self.endpoints.request() as endpoint:
+            yield endpoint.client
+
+    def create_completion(self, **kwargs):
+        with self.request_client() as client:
+            return client.chat.completions.create(**kwargs)
+
+    def stream_completion(self, **kwargs) -> StreamCutter:
+        cutter = StreamCutter()
+        with self.request_client() as client:
+            stream = client.chat.completions.create(**kwargs)
+            try:
+                for chunk in stream:
+                    if cutter.feed(chunk):
+                        break
+            finally:
+                # closing the connection makes the server abort the generation
+                stream.close()
+        return cutter
+
+    def build_request(self, messages, **extra):
+        request = dict(
             model=self.config["model_name"],
             messages=messages,
             max_completion_tokens=self.config.get("max_completion_tokens", 512),
             temperature=self.config.get("temperature", 0),
             stop=self.stop_words,
+            **extra,
         )
-        return response.choices[0].message.content
+        if self.config.get("stream", False):
+            request["stream"] = True
+            request["stream_options"] = {"include_usage": True}
+        return request
+
+    def cache_key(self, request):
+        # only greedy completions are reproducible; sampled ones must stay fresh
+        if self.cache is None or request["temperature"] != 0:
+            return None
+        return self.cache.make_key(request)
+
+    def finish_completion(self, response, key) -> str:
+        self.last_usage = response.usage
+        self.last_stream = None
+        content = response.choices[0].message.content
+        if key is not None and content is not None:
+            self.cache.put(key, content)
+        return content
+
+    def finish_stream(self, cutter: StreamCutter, request, key) -> str:
+        # the usage chunk only arrives when the stream ran to the end; a stream
+        # closed early only tells how many content chunks (about one token each) were received
+        self.last_usage = cutter.usage
+        self.last_stream = {"early_stop": cutter.cut, "stream_chunks": cutter.chunks}
+        with self._stream_totals_lock:
+            self.stream_totals["streams"] += 1
+            self.stream_totals["early_stops"] += int(cutter.cut)
+            self.stream_totals["chunks"] += cutter.chunks
+        if key is not None:
+            self.cache.put(key, cutter.text)
+        return cutter.text
+
+    def complete(self, messages, **extra) -> str:
+        request = self.build_request(messages, **extra)
+        key = self.cache_key(request)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.last_usage = None
+                self.last_stream = None
+                return cached
+
+        if request.get("stream"):
+            return self.finish_stream(self.stream_completion(**request), request, key)
+        response = self.create_completion(**request)
+        return self.finish_completion(response, key)
+
+    def workflow_messages(self, messages):
+        return messages + [{"role": "assistant", "content": self.workflow + "Thought: "}]
+
+    @backoff.on_exception(backoff.fibo, RETRY_ERRORS)
+    def __call__(self, messages) -> str:
+        return self.complete(messages)
     
     def call_with_workflow(self, messages) -> str:
-        # Prepend the prompt with the system message
-        new_messages = messages + [{"role": "assistant", "content": self.workflow + "Thought: "}]
-        response = self.client.chat.completions.create(
-            model=self.config["model_name"],
-            messages=new_messages,
-            max_completion_tokens=self.config.get("max_completion_tokens", 512),
-            temperature=self.config.get("temperature", 0),
-            stop=self.stop_words,
-            extra_body={
-                "continue_final_message": True,
-                "add_generation_prompt": False
-            }
+        return self.complete(
+            self.workflow_messages(messages),
+            extra_body=CONTINUE_FINAL_MESSAGE,
         )
-        return response.choices[0].message.content
@@ -1,3 +1,4 @@
-from .base import BaseEnv
-from .alfworld_env import AlfWorldEnv
+from .base import BaseEnv, freeze, load_json_asset, load_text_asset
+from .alfworld_env import AlfWorldEnv, AlfWorldBatchEnv
 from .sciworld_env import SciWorldEnv
+from .pool import SciWorldEnvPool
@@ -0,0 +1,68 @@
+import math
+import re
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(text.lower())
+
+
+class ActionMatcher:
+    """Maps a free-form action onto the closest of a list of admissible commands.
+
+    An inverted index from token to commands is built once per command list.
+    A query only scores the commands that share the most informative tokens
+    with it (weighted by inverse document frequency), so it stays cheap on
+    the thousands of action combinations SciWorld lists. The confidence of a
+    match is the character-level similarity of the normalized strings.
+    """
+
+    def __init__(self, commands: Sequence[str], n_candidates: int = 20):
+        self.commands = list(commands)
+        self.normalized = [" ".join(tokenize(command)) for command in self.commands]
+        self.exact: Dict[str, int] = {}
+        for idx, normalized in enumerate(self.normalized):
+            self.exact.setdefault(normalized, idx)
+        self.index: Dict[str, List[int]] = defaultdict(list)
+        for idx, normalized in enumerate(self.normalized):
+            for token in set(normalized.split()):
+                self.index[token].append(idx)
+        self.idf = {
+            token: math.log((1 + len(self.commands)) / (1 + len(ids)))
+            for token, ids in self.index.items()
+        }
+        self.n_candidates = n_candidates
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def for_commands(cls, commands: Tuple[str, ...]) -> "ActionMatcher":
+        """A matcher per distinct command list; AlfWorld lists repeat across steps and episodes."""
+        return cls(commands)
+
+    def candidates(self, tokens: List[str]) -> List[int]:
+        overlap = Counter()
+        for token in set(tokens):
+            for idx in self.index.get(token, ()):
+                overlap[idx] += self.idf[token]
+        return [idx for idx, _ in overlap.most_common(self.n_candidates)]
+
+    def match(self, action: str) -> Optional[Tuple[str, float]]:
+        """The closest command and its confidence in [0, 1], or None if no command shares a token."""
+        tokens = tokenize(action)
+        normalized = " ".join(tokens)
+        if normalized in self.exact:
+            return self.commands[self.exact[normalized]], 1.0
+        best, best_score = None, 0.0
+        for idx in self.candidates(tokens):
+            score = SequenceMatcher(None, normalized, self.normalized[idx]).ratio()
+            if score > best_score:
+                best, best_score = idx, score
+        if best is None:
+            return None
+        return self.commands[best], best_score
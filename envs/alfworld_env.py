@@ -1,11 +1,11 @@
 import re
-import json
+import time
 import logging
-from typing import Any, Dict, List, Tuple
+from typing import Dict, Iterable, Optional, Tuple
 
 from envs import BaseEnv
 from tasks import AlfWorldTask
-from prompt import prompt_with_icl
+from prompt import prompt_with_icl, initial_history
 from utils.datatypes import State
 
 
@@ -18,6 +18,10 @@ def process_ob(ob):
     return ob
 
 
+def unpack_step(observation, done, info, slot: int):
+    return process_ob(observation[slot]), info['won'][slot], done[slot]
+
+
 class AlfWorldEnv(BaseEnv):
     def __init__(
         self,
@@ -27,6 +31,9 @@ class AlfWorldEnv(BaseEnv):
         super().__init__(**kwargs)
         self.task: AlfWorldTask = task
         self.env = task.env
+        self.admissible_commands = task.admissible_commands
+        # the game env of the last finished task, reloaded with the next task's game
+        self.game_env = None
         self.state = State()
         self.bad_steps = 0
         self.max_bad_steps = 50
@@ -42,37 +49,63 @@ class AlfWorldEnv(BaseEnv):
         return action
     
     def conduct_action(self, action: str):
-        observation, reward, done, info = self.env.step([action])
-        observation, reward, done = process_ob(observation[0]), info['won'][0], done[0]
-        return observation, reward, done
+        start = time.perf_counter()
+        with self.trace.span("env_step"):
+            observation, reward, done, info = self.env.step([action])
+        self.state.step_record().env_time = time.perf_counter() - start
+        self.admissible_commands = info["admissible_commands"][0]
+        return unpack_step(observation, done, info, 0)
     
     def step(self, llm_output: str) -> Tuple[str, State]:
+        action = self.begin_step(llm_output)
+        if action is None:
+            return self.bad_step()
+        try:
+            observation, reward, done = self.conduct_action(action)
+        except Exception as e:
+            return self.bad_step()
+        return self.end_step(observation, reward, done)
+
+    def begin_step(self, llm_output: str) -> Optional[str]:
+        """Record the agent output and return the parsed action, or None if it has none."""
         self.state.history.append({
             "role": "assistant",
             "content": llm_output
         })
         try:
-            action = self.parse_action(llm_output)
-            observation, reward, done = self.conduct_action(action)
+            with self.trace.span("parse"):
+                action = self.parse_action(llm_output)
         except Exception as e:
-            self.state.success = False
-            self.state.finished = False
-            self.state.reward=0
-            observation = f"Observation: Error Input. Your input must contains 'Action: '"
-            self.state.history.append({
-                "role": "user",
-                "content": observation,
-            })
-            self.state.steps += 1
-            self.bad_steps += 1
-            if self.state.steps >= self.max_steps or self.bad_steps >= self.max_bad_steps:
-                self.state.finished = True
-                self.state.success = False
-                self.state.terminate_reason = "max_steps"
-                self.state.reward = 0
-            return observation, self.state
+            return None
+        action = self.canonicalize(action, self.admissible_commands)
+        self.state.step_record().action = action
+        return action
 
+    def bad_step(self) -> Tuple[str, State]:
+        self.state.success = False
+        self.state.finished = False
+        self.state.reward=0
+        observation = f"Observation: Error Input. Your input must contains 'Action: '"
+        record = self.state.step_record()
+        record.observation = observation
+        record.reward = 0
+        self.state.history.append({
+            "role": "user",
+            "content": observation,
+        })
+        self.state.steps += 1
+        self.bad_steps += 1
+        if self.state.steps >= self.max_steps or self.bad_steps >= self.max_bad_steps:
+            self.state.finished = True
+            self.state.success = False
+            self.state.terminate_reason = "max_steps"
+            self.state.reward = 0
+        return observation, self.state
 
+    def end_step(self, observation: str, reward: float, done: bool) -> Tuple[str, State]:
+        record = self.state.step_record()
+        record.observation = observation
+        record.reward = reward
         observation = f"Observation: {observation}"
 
         if self.args.incorporation_type == "observation" and self.task.workflow:
@@ -98,30 +131,85 @@ class AlfWorldEnv(BaseEnv):
 
         return observation, self.state
 
-    def reset(self) -> Tuple[str, State]:
+    def reset(self, task: Optional[AlfWorldTask] = None) -> Tuple[str, State]:
+        if task is not None:
+            if not task.loaded and self.game_env is not None:
+                task.detach(self.game_env)
+                self.game_env = None
+            self.task = task
+            self.env = task.env
+            self.admissible_commands = task.admissible_commands
         self.state = State()
+        self.bad_steps = 0
         cur_task = self.task.observation
-        if self.args.incorporation_type == "query":
-            observation, messages = prompt_with_icl(
-                instruction=self.instruction, 
-                raw_icl=self.raw_icl[self.task.task_type], 
-                cur_task=cur_task, 
-                icl_num=1,
-                workflow=self.task.workflow,
-            )
-        else:
-            observation, messages = prompt_with_icl(
-                instruction=self.instruction, 
-                raw_icl=self.raw_icl[self.task.task_type], 
-                cur_task=cur_task, 
-                icl_num=1,
-                workflow=None,
-            )
-        if self.icl_format == 'first':
-            self.state.history.append({
-                "role": "user",
-                "content": observation,
-            })
-        elif self.icl_format == 'conversation':
-            self.state.history = messages
+        observation, messages = prompt_with_icl(
+            instruction=self.instruction, 
+            raw_icl=self.raw_icl[self.task.task_type], 
+            cur_task=cur_task, 
+            icl_num=1,
+            workflow=self.task.workflow if self.args.incorporation_type == "query" else None,
+            cache_key=(*self.prompt_key, self.task.task_type, 1, self.icl_format),
+        )
+        self.state.history = initial_history(observation, messages, self.icl_format)
         return observation, self.state
+
+    def release(self) -> None:
+        # keep the game env of the finished task for the next one instead of closing it
+        env = self.task.take_env()
+        if env is not None:
+            self.close()
+            self.game_env = env
+
+    def close(self) -> None:
+        if self.game_env is not None:
+            self.game_env.close()
+            self.game_env = None
+
+class AlfWorldBatchEnv:
+    """Advances the AlfWorldEnv of several slots with one batched textworld step.
+
+    `env` is created by `init_env(batch_size=K)` and holds one game per slot.
+    The batched env steps every game that is not done, so the env is only
+    stepped once each running slot has a parsed action. A slot whose output
+    could not be parsed keeps its game untouched and is queried again, while
+    the actions of the other slots wait in `pending`. Only finished slots
+    receive the no-op action.
+    """
+
+    noop_action = "look"
+
+    def __init__(self, env, batch_size: int):
+        self.env = env
+        self.batch_size = batch_size
+        # slot -> (slot env, action) of slots waiting for the next batched step
+        self.pending: Dict[int, Tuple[AlfWorldEnv, str]] = {}
+
+    def step(
+        self, slot_outputs: Dict[int, Tuple[AlfWorldEnv, str]], running: Iterable[int]
+    ) -> Dict[int, Tuple[str, State]]:
+        """Parse the outputs of the queried slots of `running` and step the env once none is left without an action."""
+        results = {}
+        for slot, (slot_env, llm_output) in slot_outputs.items():
+            action = slot_env.begin_step(llm_output)
+            if action is None:
+                results[slot] = slot_env.bad_step()
+            else:
+                self.pending[slot] = (slot_env, action)
+
+        running = [slot for slot in running if not (slot in results and results[slot][1].finished)]
+        if not self.pending or any(slot not in self.pending for slot in running):
+            return results
+
+        actions = [self.noop_action] * self.batch_size
+        for slot, (_, action) in self.pending.items():
+            actions[slot] = action
+        start = time.perf_counter()
+        observation, _, done, info = self.env.step(actions)
+        dur = time.perf_counter() - start
+        for slot, (slot_env, _) in self.pending.items():
+            slot_env.trace.add("env_step", start, dur, batch=len(self.pending))
+            slot_env.state.step_record().env_time = dur
+            slot_env.admissible_commands = info["admissible_commands"][slot]
+            results[slot] = slot_env.end_step(*unpack_step(observation, done, info, slot))
+        self.pending = {}
+        return results
@@ -1,10 +1,39 @@
 import json
 from abc import ABC, abstractmethod
-from typing import Tuple
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Optional, Sequence, Tuple
+from envs.action_matcher import ActionMatcher
 from utils.datatypes import State
+from utils.tracing import NULL_TRACER
+
+
+def freeze(obj: Any) -> Any:
+    """Read-only copy of parsed JSON: dicts become mapping proxies and lists tuples."""
+    if isinstance(obj, dict):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+@lru_cache(maxsize=None)
+def load_text_asset(path: str) -> str:
+    """Contents of a static text file, read once per process."""
+    with open(path) as f:
+        return f.read()
+
+
+@lru_cache(maxsize=None)
+def load_json_asset(path: str) -> Any:
+    """A static JSON file, parsed once per process and shared read-only by all envs."""
+    with open(path) as f:
+        return freeze(json.load(f))
 
 
 class BaseEnv(ABC):
+    """An env is created once per worker and re-armed for each task with `reset(task)`."""
+
     def __init__(
         self,
         instruction_path: str,
@@ -13,17 +42,46 @@ class BaseEnv(ABC):
         max_steps: int = 10,
         **kwargs,
     ):
-        with open(instruction_path) as f:
-            self.instruction = f.read()
-        self.raw_icl = json.load(open(icl_path))
+        self.instruction = load_text_asset(instruction_path)
+        self.raw_icl = load_json_asset(icl_path)
+        # identifies the instruction and ICL assets in the prompt prefix cache
+        self.prompt_key = (instruction_path, icl_path)
         self.icl_format = icl_format
         self.max_steps = max_steps
+        self.trace = NULL_TRACER.episode()
+
+    def canonicalize(self, action: str, commands: Optional[Sequence[str]]) -> str:
+        """Rewrite `action` to the closest admissible command, if `--action_match_threshold` is set.
+
+        The action is kept when it is admissible already, when the match is less
+        confident than the threshold, or when the env listed no commands. A
+        rewrite is recorded on the step, so the trajectory keeps the parsed action.
+        """
+        threshold = self.args.action_match_threshold
+        if threshold is None or not commands:
+            return action
+        with self.trace.span("match") as span:
+            match = ActionMatcher.for_commands(tuple(commands)).match(action)
+            if match is None or match[0] == action or match[1] < threshold:
+                return action
+            command, score = match
+            span["rewritten"] = True
+        self.state.step_record().rewrite = {"from": action, "score": round(score, 4)}
+        return command
 
+    def release(self) -> None:
+        """Called when the episode is over and the env goes back to the idle envs."""
+        pass
+
+    def close(self) -> None:
+        """Shut down what the env keeps between episodes."""
+        pass
 
     @abstractmethod
     def step(self, llm_output: str) -> Tuple[str, State]:
         pass
 
     @abstractmethod
-    def reset(self) -> Tuple[str, State]:
+    def reset(self, task: Optional[Any] = None) -> Tuple[str, State]:
+        """Start an episode of `task`, or of the current task if not given."""
         pass
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from py4j.protocol import Py4JError
+from scienceworld import ScienceWorldEnv
+
+from utils.replace_sciworld_score import sciworld_monkey_patch
+
+
+logger = logging.getLogger("agent_eval")
+
+
+class SciWorldEnvPool:
+    """A fixed set of ScienceWorld servers (one JVM each) leased to episodes.
+
+    Servers are health-checked when they are leased and after an episode
+    failed on them; a server that does not answer is shut down and replaced.
+
+    The pool remembers which sub-task each server loaded last. With
+    `affinity`, a lease for a sub-task prefers an idle server that already
+    has it loaded over the one idle the longest.
+    """
+
+    # errors raised when the JVM behind a server died or the gateway is gone
+    server_errors = (Py4JError, ConnectionError, EOFError)
+
+    def __init__(
+        self, size: int, jar_path: str, env_step_limit: int = 200, affinity: bool = False, lazy_info: bool = True
+    ):
+        self.size = size
+        self.jar_path = os.path.join(os.getcwd(), jar_path)
+        self.env_step_limit = env_step_limit
+        self.affinity = affinity
+        self.lazy_info = lazy_info
+        self.restarts = 0
+        # leases for a sub-task other than the one on the server, and for the same one
+        self.load_switches = 0
+        self.load_reuses = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle: List[ScienceWorldEnv] = [self._start() for _ in range(size)]
+        self._loaded: Dict[int, str] = {}
+        logger.info(f"Started {size} ScienceWorld servers")
+
+    def _start(self) -> ScienceWorldEnv:
+        env = ScienceWorldEnv("", serverPath=self.jar_path, envStepLimit=self.env_step_limit)
+        sciworld_monkey_patch(env, lazy=self.lazy_info)
+        return env
+
+    def healthy(self, env: ScienceWorldEnv) -> bool:
+        try:
+            env.getTaskNames()
+        except Exception:
+            return False
+        return True
+
+    def restart(self, env: ScienceWorldEnv) -> ScienceWorldEnv:
+        logger.warning("ScienceWorld server is not responding, restarting it")
+        try:
+            env.close()
+        except Exception:
+            pass
+        with self._lock:
+            self.restarts += 1
+            self._loaded.pop(id(env), None)
+        return self._start()
+
+    def _acquire(self, sub_task_name: Optional[str]) -> ScienceWorldEnv:
+        with self._available:
+            while not self._idle:
+                self._available.wait()
+            idx = 0
+            if self.affinity and sub_task_name is not None:
+                idx = next(
+                    (i for i, env in enumerate(self._idle) if self._loaded.get(id(env)) == sub_task_name), 0
+                )
+            env = self._idle.pop(idx)
+            if sub_task_name is not None:
+                loaded = self._loaded.get(id(env))
+                if loaded == sub_task_name:
+                    self.load_reuses += 1
+                elif loaded is not None:
+                    self.load_switches += 1
+                self._loaded[id(env)] = sub_task_name
+            return env
+
+    def _release(self, env: ScienceWorldEnv) -> None:
+        with self._available:
+            self._idle.append(env)
+            self._available.notify()
+
+    @contextmanager
+    def lease(self, sub_task_name: Optional[str] = None) -> Iterator[ScienceWorldEnv]:
+        """Lease a server for an episode of `sub_task_name`."""
+        env = self._acquire(sub_task_name)
+        try:
+            if not self.healthy(env):
+                env = self.restart(env)
+            yield env
+        except self.server_errors:
+            if not self.healthy(env):
+                env = self.restart(env)
+            raise
+        finally:
+            self._release(env)
+
+    @asynccontextmanager
+    async def lease_async(self, sub_task_name: Optional[str] = None) -> AsyncIterator[ScienceWorldEnv]:
+        """`lease` for coroutines: waiting for a server, health checks and restarts run in a thread."""
+        env = await asyncio.to_thread(self._acquire, sub_task_name)
+        try:
+            if not await asyncio.to_thread(self.healthy, env):
+                env = await asyncio.to_thread(self.restart, env)
+            yield env
+        except self.server_errors:
+            if not await asyncio.to_thread(self.healthy, env):
+                env = await asyncio.to_thread(self.restart, env)
+            raise
+        finally:
+            self._release(env)
+
+    def stats(self) -> str:
+        return (
+            f"ScienceWorld servers switched sub-task {self.load_switches} times and reloaded "
+            f"the sub-task they already had {self.load_reuses} times"
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for env in idle:
+            try:
+                env.close()
+            except Exception:
+                pass
@@ -1,13 +1,13 @@
 import re
-import json
+import time
 import logging
-from typing import Tuple
+from typing import Optional, Tuple
 
 from scienceworld import ScienceWorldEnv
 
-from envs import BaseEnv
+from envs import BaseEnv, load_json_asset
 from tasks import SciWorldTask
-from prompt import prompt_with_icl
+from prompt import prompt_with_icl, initial_history
 from utils.datatypes import State
 
 
@@ -24,9 +24,12 @@ class SciWorldEnv(BaseEnv):
         super().__init__(**kwargs)
         self.task: SciWorldTask = task
         self.env = env
-        self.max_steps_dict = json.load(open("data/sciworld/max_steps.json"))
+        self.max_steps_dict = load_json_asset("data/sciworld/max_steps.json")
 
         self.max_error_step = 10
+        # info of the last reset or step; its `valid` action combinations are
+        # only fetched from the server when the action matcher needs them
+        self.last_info = None
         
         self.state = State()
     
@@ -43,9 +46,13 @@ class SciWorldEnv(BaseEnv):
             "content": llm_output
         })
         try:
-            action = self.parse_action(llm_output)
+            with self.trace.span("parse"):
+                action = self.parse_action(llm_output)
         except:
             observation = f"Observation: Invalid format. The input must contains 'Action: '"
+            record = self.state.step_record()
+            record.observation = observation
+            record.reward = 0
             self.state.history.append({
                 "role": "user",
                 "content": observation,
@@ -58,9 +65,19 @@ class SciWorldEnv(BaseEnv):
                 self.state.terminate_reason = "max_steps"
                 self.state.reward = 0
             return observation, self.state
+        record = self.state.step_record()
+        if self.args.action_match_threshold is not None and self.last_info is not None:
+            action = self.canonicalize(action, self.last_info.get("valid"))
+        record.action = action
         try:
-            observation, _, done, info = self.env.step(action)
+            start = time.perf_counter()
+            with self.trace.span("env_step"):
+                observation, _, done, info = self.env.step(action)
+            record.env_time = time.perf_counter() - start
+            self.last_info = info
             reward = info['raw_score']
+            record.observation = observation
+            record.reward = reward
 
             if "No known action matches that input" in observation:
                 self.state.error_step += 1
@@ -76,6 +93,7 @@ class SciWorldEnv(BaseEnv):
                 self.state.reward = reward
         except AssertionError:
             observation = 'Observation: Invalid action!'
+            record.observation = observation
             done = False
 
         if self.args.incorporation_type == "observation" and self.task.workflow:
@@ -99,36 +117,24 @@ class SciWorldEnv(BaseEnv):
 
         return observation, self.state
     
-    def reset(self) -> Tuple[str, State]:
+    def reset(self, task: Optional[SciWorldTask] = None) -> Tuple[str, State]:
+        if task is not None:
+            self.task = task
         self.state = State()
         self.state.error_step = 0
         self.max_steps = self.max_steps_dict[self.task.sub_task_name]
         self.env.load(self.task.sub_task_name, self.task.variation_idx, simplificationStr="easy", generateGoldPath=False)
         obs, info = self.env.reset()
+        self.last_info = info
         cur_task = info['taskDesc']
         self.taskDesc = cur_task
-        if self.args.incorporation_type == "query":
-            observation, messages = prompt_with_icl(
-                instruction=self.instruction,
-                raw_icl=self.raw_icl,
-                cur_task=cur_task,
-                icl_num=1,
-                workflow=self.task.workflow,
-            )
-        else:
-            observation, messages = prompt_with_icl(
-                instruction=self.instruction,
-                raw_icl=self.raw_icl,
-                cur_task=cur_task,
-                icl_num=1,
-                workflow=None,
-            )
-
-        if self.icl_format == 'first':
-            self.state.history.append({
-                "role": "user",
-                "content": observation,
-            })
-        elif self.icl_format == 'conversation':
-            self.state.history = messages
+        observation, messages = prompt_with_icl(
+            instruction=self.instruction,
+            raw_icl=self.raw_icl,
+            cur_task=cur_task,
+            icl_num=1,
+            workflow=self.task.workflow if self.args.incorporation_type == "query" else None,
+            cache_key=(*self.prompt_key, None, 1, self.icl_format),
+        )
+        self.state.history = initial_history(observation, messages, self.icl_format)
         return observation, self.state
@@ -1,9 +1,14 @@
 import argparse
+import asyncio
 import json
 import logging
 import os
 import pathlib
-from typing import Any, Dict
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from colorama import Fore
 from tqdm import tqdm
@@ -13,54 +18,136 @@ import agents as agents
 import envs as envs
 import tasks as tasks
 from utils.datatypes import State
+from utils.manifest import RunManifest
+from utils.store import RESULT_BACKENDS
+from utils.tokenizer import token_counter
+from utils.tracing import NULL_TRACER, EpisodeTrace, Tracer
 
 logger = logging.getLogger("agent_eval")
 args = None
+tracer = NULL_TRACER
+_worker = threading.local()
+# envs of finished episodes, kept to be re-armed for the next task of their class
+_idle_envs: Dict[str, List[envs.BaseEnv]] = {}
+_idle_envs_lock = threading.Lock()
 
-def interactive_loop(
+def make_agent(agent_config: Dict[str, Any]) -> agents.BaseAgent:
+    return getattr(agents, agent_config["agent_class"])(agent_config["config"])
+
+
+def is_async_agent(agent_config: Dict[str, Any]) -> bool:
+    return asyncio.iscoroutinefunction(getattr(agents, agent_config["agent_class"]).__call__)
+
+
+def start_trace(task: tasks.Task) -> EpisodeTrace:
+    task_type = getattr(task, "task_type", None) or getattr(task, "sub_task_name", None)
+    # MC episodes carry their flow and run
+    return tracer.episode(task_id=task.task_id, task_type=task_type, **task.metadata)
+
+
+def _agent_request(
     task: tasks.Task,
     agent: agents.BaseAgent,
-    env_config: Dict[str, Any],
-) -> State:
-    logger.info(f"Loading environment: {env_config['env_class']}")
-    env: envs.BaseEnv = getattr(envs, env_config["env_class"])(task, **env_config)
-    env.args = args
-    # reset the environment and set the prompt
-    observation, state = env.reset()
-
-    init_msg = observation
+    state: State,
+    window: Optional[agents.ContextWindow],
+) -> Tuple[List[Dict[str, Any]], bool]:
+    use_workflow = args.incorporation_type == "thought" and bool(task.workflow)
+    if use_workflow:
+        agent.set_workflow(f"This workflow maybe helpful to complete the task:\n{task.workflow}\n")
+    messages = window.build(state) if window is not None else state.history
+    return messages, use_workflow
+
+
+def _agent_span_fields(state: State, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "step": state.steps,
+        "prompt_messages": len(messages),
+        "prompt_chars": sum(len(message["content"]) for message in messages),
+    }
+
+
+def _agent_failed(state: State, span: Dict[str, Any], e: Exception) -> None:
+    logger.info(f"Agent failed with error: {e}")
+    state.success = False
+    state.finished = True
+    state.terminate_reason = "exceeding maximum input length"
+    span["error"] = str(e)
+
+
+def _agent_replied(
+    agent: agents.BaseAgent, state: State, span: Dict[str, Any], llm_output: str, start: float
+) -> None:
+    logger.info(
+        f"\n{Fore.GREEN}{llm_output}{Fore.RESET}\n"
+    )
+    span["completion_chars"] = len(llm_output)
+    record = state.step_record()
+    record.agent_time = time.perf_counter() - start
+    if agent.last_usage is not None:
+        span["prompt_tokens"] = record.prompt_tokens = agent.last_usage.prompt_tokens
+        span["completion_tokens"] = record.completion_tokens = agent.last_usage.completion_tokens
+    if agent.last_stream is not None:
+        span.update(agent.last_stream)
 
-    logger.info(f"\n{Fore.YELLOW}{init_msg}{Fore.RESET}")
 
-    while not state.finished:
-        if args.incorporation_type == "thought"  and task.workflow:
-            agent.set_workflow(f"This workflow maybe helpful to complete the task:\n{task.workflow}\n")
+def agent_act(
+    task: tasks.Task,
+    agent: agents.BaseAgent,
+    state: State,
+    trace: EpisodeTrace,
+    window: Optional[agents.ContextWindow] = None,
+) -> Optional[str]:
+    """Query the agent for its next turn. Marks the episode failed and returns None on error."""
+    messages, use_workflow = _agent_request(task, agent, state, window)
+    with trace.span("agent", **_agent_span_fields(state, messages)) as span:
+        start = time.perf_counter()
         try:
-            if args.incorporation_type == "thought" and task.workflow:
-                llm_output = agent.call_with_workflow(state.history)
+            if use_workflow:
+                llm_output = agent.call_with_workflow(messages)
             else:
-                llm_output: str = agent(state.history)
-            logger.info(
-                f"\n{Fore.GREEN}{llm_output}{Fore.RESET}\n"
-            )
+                llm_output: str = agent(messages)
         except Exception as e:
-            logger.info(f"Agent failed with error: {e}")
-            state.success = False
-            state.finished = True
-            state.terminate_reason = "exceeding maximum input length"
-            break
+            _agent_failed(state, span, e)
+            return None
+        _agent_replied(agent, state, span, llm_output, start)
+    return llm_output
 
-        # environment step
-        observation, state = env.step(llm_output)
-        if not state.finished:
-            # color the observation in blue
-            logger.info(
-                f"\n{Fore.BLUE}{observation}{Fore.RESET}\n"
-            )
 
-        if state.finished:
-            break
+async def agent_act_async(
+    task: tasks.Task,
+    agent: agents.AsyncOpenAIAgent,
+    state: State,
+    trace: EpisodeTrace,
+    window: Optional[agents.ContextWindow] = None,
+) -> Optional[str]:
+    """`agent_act` for agents whose calls are coroutines."""
+    messages, use_workflow = _agent_request(task, agent, state, window)
+    with trace.span("agent", **_agent_span_fields(state, messages)) as span:
+        start = time.perf_counter()
+        try:
+            if use_workflow:
+                llm_output = await agent.call_with_workflow(messages)
+            else:
+                llm_output: str = await agent(messages)
+        except Exception as e:
+            _agent_failed(state, span, e)
+            return None
+        _agent_replied(agent, state, span, llm_output, start)
+    return llm_output
+
+
+def make_context_window(state: State) -> Optional[agents.ContextWindow]:
+    """A context window pinning the initial prompt, or None when no budget is set."""
+    if args.context_budget is None:
+        return None
+    return agents.ContextWindow(
+        budget=args.context_budget,
+        count_tokens=token_counter(args.tokenizer),
+        n_pinned=len(state.history),
+    )
 
+
+def log_episode_end(state: State) -> None:
     if state.reward is not None:
         logger.info(
             f"Task finished in {state.steps} steps. Success: {state.success}. Reward: {state.reward}"
@@ -70,10 +157,342 @@ def interactive_loop(
             f"Task finished in {state.steps} steps. Success: {state.success}"
         )
 
+
+def acquire_env(task: tasks.Task, env_config: Dict[str, Any]) -> envs.BaseEnv:
+    """An idle env of the configured class, or a new one if every env is in use.
+
+    There are never more envs than episodes running at once, so each worker
+    ends up with one env that `reset(task)` re-arms for each of its tasks.
+    """
+    with _idle_envs_lock:
+        idle = _idle_envs.setdefault(env_config["env_class"], [])
+        env = idle.pop() if idle else None
+    if env is None:
+        logger.info(f"Loading environment: {env_config['env_class']}")
+        env = getattr(envs, env_config["env_class"])(task, **env_config)
+    elif "env" in env_config:
+        # the SciWorld server leased for this episode
+        env.env = env_config["env"]
+    return env
+
+
+def release_env(env: envs.BaseEnv, env_config: Dict[str, Any]) -> None:
+    env.release()
+    with _idle_envs_lock:
+        _idle_envs[env_config["env_class"]].append(env)
+
+
+def close_idle_envs() -> None:
+    with _idle_envs_lock:
+        idle = [env for envs_of_class in _idle_envs.values() for env in envs_of_class]
+        _idle_envs.clear()
+    for env in idle:
+        env.close()
+
+
+def start_episode(
+    task: tasks.Task,
+    env_config: Dict[str, Any],
+) -> Tuple[envs.BaseEnv, State]:
+    env = acquire_env(task, env_config)
+    env.args = args
+    env.trace = start_trace(task)
+    # reset the environment and set the prompt
+    try:
+        with env.trace.span("reset"):
+            observation, state = env.reset(task)
+    except BaseException:
+        release_env(env, env_config)
+        task.close()
+        raise
+
+    init_msg = observation
+
+    logger.info(f"\n{Fore.YELLOW}{init_msg}{Fore.RESET}")
+    return env, state
+
+
+def log_observation(observation: str, state: State) -> None:
+    if not state.finished:
+        # color the observation in blue
+        logger.info(
+            f"\n{Fore.BLUE}{observation}{Fore.RESET}\n"
+        )
+
+
+def interactive_loop(
+    task: tasks.Task,
+    agent: agents.BaseAgent,
+    env_config: Dict[str, Any],
+) -> State:
+    env, state = start_episode(task, env_config)
+    window = make_context_window(state)
+
+    try:
+        while not state.finished:
+            llm_output = agent_act(task, agent, state, env.trace, window)
+            if llm_output is None:
+                break
+
+            # environment step
+            observation, state = env.step(llm_output)
+            log_observation(observation, state)
+
+            if state.finished:
+                break
+    finally:
+        release_env(env, env_config)
+        task.close()
+
+    log_episode_end(state)
+    env.trace.finish(state)
+
     return state
 
 
-def main(args: argparse.Namespace):
+async def interactive_loop_async(
+    task: tasks.Task,
+    agent: agents.AsyncOpenAIAgent,
+    env_config: Dict[str, Any],
+) -> State:
+    """`interactive_loop` that awaits the agent and runs blocking env calls in a thread."""
+    env, state = await asyncio.to_thread(start_episode, task, env_config)
+    window = make_context_window(state)
+
+    try:
+        while not state.finished:
+            llm_output = await agent_act_async(task, agent, state, env.trace, window)
+            if llm_output is None:
+                break
+
+            observation, state = await asyncio.to_thread(env.step, llm_output)
+            log_observation(observation, state)
+    finally:
+        release_env(env, env_config)
+        await asyncio.to_thread(task.close)
+
+    log_episode_end(state)
+    env.trace.finish(state)
+
+    return state
+
+
+def run_episode(
+    task: tasks.Task,
+    agent: agents.BaseAgent,
+    env_config: Dict[str, Any],
+    env_pool: Optional[envs.SciWorldEnvPool] = None,
+) -> State:
+    """Run one episode, on a server leased from `env_pool` if there is one.
+
+    An episode interrupted by a crashed server is retried once on the
+    restarted server.
+    """
+    if env_pool is None:
+        return interactive_loop(task, agent, env_config)
+    for attempt in range(2):
+        with env_pool.lease(getattr(task, "sub_task_name", None)) as server:
+            try:
+                return interactive_loop(task, agent, {**env_config, "env": server})
+            except env_pool.server_errors as e:
+                if attempt == 1:
+                    raise
+                logger.warning(f"Task {task.task_id} lost its env server ({e}), retrying")
+
+
+def pending_tasks(all_tasks: Iterable[tasks.Task], done_task_id) -> Iterator[tasks.Task]:
+    for i, task in enumerate(all_tasks):
+        # Only test 10 tasks in debug mode
+        if args.debug and i == 5:
+            break
+
+        # skip done tasks
+        if task.task_id in done_task_id:
+            continue
+
+        yield task
+
+
+def run_sequential(
+    todo_tasks: Iterable[tasks.Task],
+    agent: agents.BaseAgent,
+    env_config: Dict[str, Any],
+    env_pool: Optional[envs.SciWorldEnvPool] = None,
+) -> Iterator[Tuple[tasks.Task, State]]:
+    for task in todo_tasks:
+        state = run_episode(
+            task, agent, env_config, env_pool
+        )
+        yield task, state
+
+
+def _run_in_worker(
+    task: tasks.Task,
+    agent_config: Dict[str, Any],
+    env_config: Dict[str, Any],
+    env_pool: Optional[envs.SciWorldEnvPool],
+) -> State:
+    # every worker thread owns its agent, and every episode an env that
+    # loads its game on reset, so episodes never share an agent workflow or
+    # simulator state
+    if not hasattr(_worker, "agent"):
+        _worker.agent = make_agent(agent_config)
+    return run_episode(task, _worker.agent, env_config, env_pool)
+
+
+def run_concurrent(
+    todo_tasks: Iterable[tasks.Task],
+    agent_config: Dict[str, Any],
+    env_config: Dict[str, Any],
+    concurrency: int,
+    env_pool: Optional[envs.SciWorldEnvPool] = None,
+) -> Iterator[Tuple[tasks.Task, State]]:
+    """Run up to `concurrency` episodes at once and yield them as they finish."""
+    todo_tasks = iter(todo_tasks)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = {}
+        while True:
+            # keep the window full without draining the task generator ahead of time
+            for task in todo_tasks:
+                future = executor.submit(_run_in_worker, task, agent_config, env_config, env_pool)
+                running[future] = task
+                if len(running) >= concurrency:
+                    break
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield running.pop(future), future.result()
+
+
+async def run_episode_async(
+    task: tasks.Task,
+    agent: agents.AsyncOpenAIAgent,
+    env_config: Dict[str, Any],
+    env_pool: Optional[envs.SciWorldEnvPool] = None,
+) -> State:
+    """`run_episode` as a coroutine."""
+    if env_pool is None:
+        return await interactive_loop_async(task, agent, env_config)
+    for attempt in range(2):
+        # the JVM health check and restarts of a lease block, so they run off the loop thread
+        async with env_pool.lease_async(getattr(task, "sub_task_name", None)) as server:
+            try:
+                return await interactive_loop_async(task, agent, {**env_config, "env": server})
+            except env_pool.server_errors as e:
+                if attempt == 1:
+                    raise
+                logger.warning(f"Task {task.task_id} lost its env server ({e}), retrying")
+
+
+def run_async(
+    todo_tasks: Iterable[tasks.Task],
+    agent_config: Dict[str, Any],
+    env_config: Dict[str, Any],
+    concurrency: int,
+    env_pool: Optional[envs.SciWorldEnvPool] = None,
+) -> Iterator[Tuple[tasks.Task, State]]:
+    """Run up to `concurrency` episodes as coroutines of one event loop, sharing one agent."""
+    if env_pool is not None:
+        concurrency = min(concurrency, env_pool.size)
+    agent = make_agent(agent_config)
+    todo_tasks = iter(todo_tasks)
+    loop = asyncio.new_event_loop()
+    # env steps run in this pool, one thread per episode in flight
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    try:
+        running = {}
+        while True:
+            for task in todo_tasks:
+                running[loop.create_task(run_episode_async(task, agent, env_config, env_pool))] = task
+                if len(running) >= concurrency:
+                    break
+            if not running:
+                break
+            done, _ = loop.run_until_complete(asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED))
+            for future in done:
+                yield running.pop(future), future.result()
+    finally:
+        # the connection pools are bound to this loop
+        loop.run_until_complete(agents.AsyncOpenAIAgent.close_http_clients())
+        loop.close()
+
+
+def run_batched(
+    todo_tasks: Iterable[tasks.AlfWorldTask],
+    agent_config: Dict[str, Any],
+    env_config: Dict[str, Any],
+    batch_size: int,
+) -> Iterator[Tuple[tasks.Task, State]]:
+    """Advance a wave of `batch_size` AlfWorld games in lockstep.
+
+    Each round queries the agents of the running slots that have no pending
+    action and then steps the batched env once all of them have one. This is
+    a wave barrier, not a refill: the batched textworld env can only reset all
+    of its slots together, so a finished slot idles on no-op actions until the
+    whole wave is done, and only then are the next pending tasks loaded into
+    a new wave.
+    """
+    slot_agents = [make_agent(agent_config) for _ in range(batch_size)]
+    # one AlfWorldEnv per slot, re-armed with each wave's task
+    slot_envs = {}
+    todo_tasks = iter(todo_tasks)
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        while True:
+            wave = list(islice(todo_tasks, batch_size))
+            if not wave:
+                break
+            wave = tasks.AlfWorldTask.load_wave(wave, batch_size)
+            batch_env = envs.AlfWorldBatchEnv(wave[0].env, batch_size)
+            slots = {}
+            for slot, task in enumerate(wave):
+                if slot not in slot_envs:
+                    slot_envs[slot] = envs.AlfWorldEnv(task, **env_config)
+                env = slot_envs[slot]
+                env.args = args
+                env.trace = start_trace(task)
+                with env.trace.span("reset"):
+                    observation, state = env.reset(task)
+                logger.info(f"\n{Fore.YELLOW}{observation}{Fore.RESET}")
+                slots[slot] = (task, env, state, make_context_window(state))
+
+            while slots:
+                futures = {
+                    slot: executor.submit(agent_act, task, slot_agents[slot], state, env.trace, window)
+                    for slot, (task, env, state, window) in slots.items()
+                    if slot not in batch_env.pending
+                }
+                slot_outputs = {}
+                for slot, future in futures.items():
+                    llm_output = future.result()
+                    if llm_output is not None:
+                        slot_outputs[slot] = (slots[slot][1], llm_output)
+
+                running = [slot for slot, (_, _, state, _) in slots.items() if not state.finished]
+                for slot, (observation, state) in batch_env.step(slot_outputs, running).items():
+                    log_observation(observation, state)
+
+                for slot in list(slots):
+                    task, env, state, _ = slots[slot]
+                    if state.finished:
+                        log_episode_end(state)
+                        env.trace.finish(state)
+                        del slots[slot]
+                        yield task, state
+
+            # the wave's game processes
+            batch_env.env.close()
+
+
+def log_metrics(manifest: RunManifest) -> None:
+    avg_reward, success_rate = manifest.metrics()
+    if avg_reward is not None:
+        logger.info(f"Average reward: {avg_reward:.4f}")
+    logger.info(f"Success rate: {success_rate:.4f}")
+
+
+def load_configs(args: argparse.Namespace) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Read the experiment and agent configs and apply the command line overrides."""
     with open(os.path.join(args.exp_path, f"{args.exp_config}.json")) as f:
         exp_config: Dict[str, Any] = json.load(f)
     with open(os.path.join(args.agent_path, f"{args.agent_config}.json")) as f:
@@ -82,9 +501,22 @@ def main(args: argparse.Namespace):
     if args.model_name is not None:
         agent_config['config']['model_name'] = args.model_name
     if args.api_base is not None:
-        agent_config['config']['api_base'] = args.api_base
+        api_bases = args.api_base.split(",")
+        agent_config['config']['api_base'] = api_bases if len(api_bases) > 1 else api_bases[0]
     if args.api_key is not None:
         agent_config['config']['api_key'] = args.api_key
+    if args.llm_cache is not None:
+        agent_config['config']['cache_path'] = args.llm_cache
+    if args.stream_actions:
+        agent_config['config']['stream'] = True
+    if args.context_budget is not None and args.tokenizer is None:
+        args.tokenizer = agent_config['config']['model_name']
+    return exp_config, agent_config
+
+
+def main(args: argparse.Namespace):
+    global tracer
+    exp_config, agent_config = load_configs(args)
 
     exp_name = args.exp_name or args.exp_config
 
@@ -104,15 +536,19 @@ def main(args: argparse.Namespace):
     )
 
     env_config = exp_config["env_config"]
+    assert args.batch_size == 1 or env_config['env_class'] == 'AlfWorldEnv', "--batch_size is only supported for AlfWorld"
     
     logger.info(f"Experiment config: \n{json.dumps(exp_config, indent=2)}")
 
 
+    env_pool = None
     if env_config['env_class'] == 'SciWorldEnv':
-        from scienceworld import ScienceWorldEnv
-        from utils.replace_sciworld_score import sciworld_monkey_patch
-        sciworld_monkey_patch()
-        env_config['env'] = ScienceWorldEnv("", serverPath=os.path.join(os.getcwd(), env_config['env_jar_path']), envStepLimit=200)
+        env_pool = envs.SciWorldEnvPool(
+            size=args.env_pool_size or args.concurrency,
+            jar_path=env_config['env_jar_path'],
+            affinity=args.task_order == "grouped",
+            lazy_info=not args.eager_sciworld_info,
+        )
 
     # initialize all the tasks    
     task_config: Dict[str, Any] = exp_config["task"]
@@ -129,34 +565,26 @@ def main(args: argparse.Namespace):
     )
 
     # initialize the agent
-    agent: agents.LMAgent = getattr(agents, agent_config["agent_class"])(
-        agent_config["config"]
-    )
+    use_async = is_async_agent(agent_config)
+    assert not (use_async and args.batch_size > 1), "--batch_size needs a synchronous agent"
+    if args.concurrency == 1 and args.batch_size == 1 and not use_async:
+        agent: agents.LMAgent = make_agent(agent_config)
+
+    if args.trace or args.chrome_trace:
+        tracer = Tracer(
+            os.path.join(output_path, "trace.jsonl") if args.trace else None,
+            os.path.join(output_path, "trace.chrome.json") if args.chrome_trace else None,
+        )
 
-    state_list = []
-    
-    done_task_id = []
-    if os.path.exists(output_path) and not args.override:
-        for file in os.listdir(output_path):
-            if not file.endswith('json'):
-                continue
-            state = State.load_json(json.load(open(os.path.join(output_path, file))))
-            state_list.append(state)
-            done_task_id.append(int(file.split('.')[0]))
+    manifest = RunManifest(output_path, override=args.override)
+    store = RESULT_BACKENDS[args.results_backend](output_path, override=args.override)
+    done_task_id = manifest.done_task_ids
+    if len(done_task_id) > 0:
         logger.info(f"Existing output file found. {len(done_task_id)} tasks done.")
 
 
     if len(done_task_id) == n_tasks:
-        reward_list = []
-        success_list = []
-        for state in state_list:
-            if state.reward is not None:
-                reward_list.append(state.reward)
-            success_list.append(state.success)
-
-        if len(reward_list) != 0:
-            logger.info(f"Average reward: {sum(reward_list)/len(success_list):.4f}")
-        logger.info(f"Success rate: {sum(success_list)/len(success_list):.4f}")
+        log_metrics(manifest)
         logger.info("All tasks done. Exiting.")
         return
 
@@ -164,44 +592,57 @@ def main(args: argparse.Namespace):
     logging.info(f"Running interactive loop for {n_tasks} tasks.")
     n_todo_tasks = n_tasks - len(done_task_id)  # only run the remaining tasks
 
+    todo_tasks = pending_tasks(all_tasks, done_task_id)
+    if args.task_order == "grouped":
+        assert env_config['env_class'] == 'SciWorldEnv', "--task_order grouped is only supported for SciWorld"
+        todo_tasks = list(todo_tasks)
+        switches = tasks.count_sub_task_switches(todo_tasks)
+        todo_tasks = tasks.group_by_sub_task(todo_tasks)
+        logger.info(
+            f"Grouping tasks by sub-task cuts switches between consecutive tasks "
+            f"from {switches} to {tasks.count_sub_task_switches(todo_tasks)}"
+        )
+
     with logging_redirect_tqdm():
         pbar = tqdm(total=n_todo_tasks)
-        for i, task in enumerate(all_tasks):
-            # Only test 10 tasks in debug mode
-            if args.debug and i == 5:
-                break
-
-            # skip done tasks
-            if task.task_id in done_task_id:
-                continue
-
-            state = interactive_loop(
-                task, agent, env_config
-            )
-
-            state_list.append(state)
-            json.dump(state.to_dict(), open(os.path.join(output_path, f"{task.task_id}.json"), 'w'), indent=4)
+        if args.batch_size > 1:
+            finished = run_batched(todo_tasks, agent_config, env_config, args.batch_size)
+        elif use_async:
+            finished = run_async(todo_tasks, agent_config, env_config, args.concurrency, env_pool)
+        elif args.concurrency == 1:
+            finished = run_sequential(todo_tasks, agent, env_config, env_pool)
+        else:
+            finished = run_concurrent(todo_tasks, agent_config, env_config, args.concurrency, env_pool)
+
+        for task, state in finished:
+            store.write(task.task_id, state)
+            manifest.add(task.task_id, state)
 
             pbar.update(1)
         pbar.close()
+        store.close()
+        tracer.close()
+        if env_pool is not None:
+            logger.info(env_pool.stats())
+            env_pool.close()
+        close_idle_envs()
         
         logger.info("All tasks done.")
         logger.info(f"Output saved to {output_path}")
 
         # calculate metrics
-        reward_list = []
-        success_list = []
-        for state in state_list:
-            if state.reward is not None:
-                reward_list.append(state.reward)
-            success_list.append(state.success)
-
-        if len(reward_list) != 0:
-            logger.info(f"Average reward: {sum(reward_list)/len(success_list):.4f}")
-        logger.info(f"Success rate: {sum(success_list)/len(success_list):.4f}")
+        log_metrics(manifest)
+        for cache in agents.ResponseCache.all_shared():
+            logger.info(cache.stats())
+        stream_totals = agents.OpenAIAgent.stream_totals
+        if stream_totals["streams"] > 0:
+            logger.info(
+                f"Streamed {stream_totals['streams']} completions, {stream_totals['early_stops']} closed early "
+                f"after the action line, {stream_totals['chunks']} content chunks received"
+            )
 
 
-if __name__ == "__main__":
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser("Run the interactive loop.")
     parser.add_argument(
         "--exp_path",
@@ -276,7 +717,7 @@ if __name__ == "__main__":
         "--api_base",
         type=str,
         required=False,
-        help="Agent base url. It will override the 'api_base' in agent_config",
+        help="Agent base url, or several comma-separated urls to balance requests over. It will override the 'api_base' in agent_config",
     )
     parser.add_argument(
         "--api_key",
@@ -303,9 +744,88 @@ if __name__ == "__main__":
         required=False,
         help="Directory to save the output.",
     )
-    
-    
-    args = parser.parse_args()
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of episodes to run at once. Each episode gets its own env; synchronous agents get one per worker thread, async agents are shared.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="AlfWorld only: number of games stepped together by one batched env.",
+    )
+    parser.add_argument(
+        "--env_pool_size",
+        type=int,
+        required=False,
+        help="SciWorld only: number of ScienceWorld servers to start. Defaults to --concurrency.",
+    )
+    parser.add_argument(
+        "--eager_sciworld_info",
+        action="store_true",
+        help="SciWorld only: fetch the look, inventory, task description and valid actions of every step, "
+             "instead of only when they are read.",
+    )
+    parser.add_argument(
+        "--results_backend",
+        type=str,
+        choices=list(RESULT_BACKENDS),
+        default="json",
+        help="How trajectories are saved: one JSON file per task, or sharded zstd-compressed JSONL.",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Write per-step timing spans to trace.jsonl in the output dir.",
+    )
+    parser.add_argument(
+        "--chrome_trace",
+        action="store_true",
+        help="Also write the spans in Chrome trace format to trace.chrome.json.",
+    )
+    parser.add_argument(
+        "--context_budget",
+        type=int,
+        required=False,
+        help="Token budget of the prompt. Older observations are shortened or dropped to stay under it.",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        required=False,
+        help="Tokenizer used to count tokens for --context_budget. Defaults to the model name.",
+    )
+    parser.add_argument(
+        "--llm_cache",
+        type=str,
+        required=False,
+        help="SQLite file caching greedy (temperature 0) completions across runs.",
+    )
+    parser.add_argument(
+        "--stream_actions",
+        action="store_true",
+        help="Stream completions and stop reading as soon as a complete 'Action: ...' line arrived.",
+    )
+    parser.add_argument(
+        "--task_order",
+        type=str,
+        choices=["given", "grouped"],
+        default="given",
+        help="SciWorld only: 'grouped' runs the tasks of one sub-task back to back and leases them servers that already loaded it.",
+    )
+    parser.add_argument(
+        "--action_match_threshold",
+        type=float,
+        default=None,
+        help="Rewrite a parsed action to the closest admissible command when the match confidence (0-1) is at least this. Off by default.",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
     logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
     
     main(args)
@@ -1 +1 @@
-from .templates import prompt_with_icl
\ No newline at end of file
+from .templates import prompt_with_icl, initial_history, TASK_HEADER
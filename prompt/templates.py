@@ -1,36 +1,42 @@
-import os
-import json
+import threading
+from typing import Dict, Hashable, List, Tuple
 
 
+# everything before this line of a rendered prompt is shared by all tasks
+TASK_HEADER = "Now, it's your turn and here is the task.\n"
 
-PROMPT_WITH_ICL_TEMPLATE = """{instruction}
+
+PROMPT_PREFIX_TEMPLATE = """{instruction}
 ---
 {icl_prompt}
 
 {examples}
 ---
 
-Now, it's your turn and here is the task.
-{task}"""
+""" + TASK_HEADER
 
 
-PROMPT_WITH_ICL_TEMPLATE_WORKFLOW = """{instruction}
----
-{icl_prompt}
+PROMPT_WITH_ICL_TEMPLATE = PROMPT_PREFIX_TEMPLATE + "{task}"
 
-{examples}
----
 
-Now, it's your turn and here is the task.
-{task}
+PROMPT_WITH_ICL_TEMPLATE_WORKFLOW = PROMPT_PREFIX_TEMPLATE + """{task}
 
 This workflow maybe helpful for you to complete the task:
 {workflow}"""
 
 
+# rendered instruction + ICL blocks, keyed by the caller's cache key
+_prefix_cache: Dict[Hashable, Tuple[str, Tuple[Dict[str, str], ...]]] = {}
+_prefix_cache_lock = threading.Lock()
 
-def prompt_with_icl(instruction, raw_icl, cur_task, icl_num=2, workflow=None):
-    examples = ""
+
+def render_icl_prefix(instruction, raw_icl, icl_num=2):
+    """Render the part of the prompt that precedes the task.
+
+    Returns the prefix text of the single-message prompt and the ICL
+    messages of the conversation layout.
+    """
+    examples = []
     messages = [{
         "role": "user",
         "content": instruction
@@ -48,15 +54,15 @@ def prompt_with_icl(instruction, raw_icl, cur_task, icl_num=2, workflow=None):
                     "content": cur_content
                 })
                 if icl_num > 1:
-                    examples += f"Example task {i + 1}:\n"
-                examples += cur_content + '\n'
+                    examples.append(f"Example task {i + 1}:\n")
+                examples.append(cur_content + '\n')
                 continue
             elif i != 0 and j == 0:
                 if icl_num > 1:
-                    examples += f"\nExample task {i + 1}:\n"
-                    examples += cur_content + '\n'
+                    examples.append(f"\nExample task {i + 1}:\n")
+                    examples.append(cur_content + '\n')
                 else:
-                    examples += '\n' + cur_content + '\n'
+                    examples.append('\n' + cur_content + '\n')
                 messages.append({
                     "role": "user",
                     "content": cur_content
@@ -64,41 +70,76 @@ def prompt_with_icl(instruction, raw_icl, cur_task, icl_num=2, workflow=None):
                 continue
             # user
             if j % 2 == 0:
-                examples += cur_content + '\n\n'
+                examples.append(cur_content + '\n\n')
                 messages.append({
                     "role": "user",
                     "content": cur_content
                 })
             # assistant
             else:
-                examples += cur_content + '\n'
+                examples.append(cur_content + '\n')
                 messages.append({
                     "role": "assistant",
                     "content": cur_content
                 })
     icl_prompt = f"Here are {icl_num} examples." if icl_num > 1 else f"Here is an example."
+    prefix = PROMPT_PREFIX_TEMPLATE.format(
+        instruction=instruction,
+        icl_prompt=icl_prompt,
+        examples="".join(examples),
+    )
+    return prefix, tuple(messages)
+
+
+def cached_icl_prefix(instruction, raw_icl, icl_num=2, cache_key=None):
+    """`render_icl_prefix`, memoized under `cache_key` when one is given."""
+    if cache_key is None:
+        return render_icl_prefix(instruction, raw_icl, icl_num)
+    rendered = _prefix_cache.get(cache_key)
+    if rendered is None:
+        rendered = render_icl_prefix(instruction, raw_icl, icl_num)
+        with _prefix_cache_lock:
+            _prefix_cache.setdefault(cache_key, rendered)
+    return rendered
+
+
+def prompt_with_icl(instruction, raw_icl, cur_task, icl_num=2, workflow=None, cache_key=None):
+    prefix, icl_messages = cached_icl_prefix(instruction, raw_icl, icl_num, cache_key)
+    messages = [dict(message) for message in icl_messages]
     if not workflow:
-        prompt = PROMPT_WITH_ICL_TEMPLATE.format(
-            instruction=instruction, 
-            icl_prompt=icl_prompt, 
-            examples=examples, 
-            task=cur_task
-        )
-        messages.append({
-            "role": "user",
-            "content": cur_task
-        })
+        task = cur_task
     else:
-        prompt = PROMPT_WITH_ICL_TEMPLATE_WORKFLOW.format(
-            instruction=instruction, 
-            icl_prompt=icl_prompt, 
-            examples=examples, 
-            task=cur_task, 
-            workflow=workflow
-        )
-        messages.append({
-            "role": "user",
-            "content": f"{cur_task}\n\nThis workflow maybe helpful for you to complete the task:\n{workflow}"
-        })
+        task = f"{cur_task}\n\nThis workflow maybe helpful for you to complete the task:\n{workflow}"
+    prompt = prefix + task
+    messages.append({
+        "role": "user",
+        "content": task
+    })
 
     return prompt, messages
+
+
+def initial_history(prompt: str, messages: List[Dict[str, str]], icl_format: str) -> List[Dict[str, str]]:
+    """Lay out the first turn of an episode.
+
+    `first` sends the whole prompt as one user message and `conversation`
+    replays the ICL examples as turns. `prefix` sends the shared instruction
+    and ICL block as its own message ahead of the task, so the rendered
+    prefix is byte-identical across tasks and the server's prefix cache can
+    reuse it.
+    """
+    if icl_format == 'first':
+        return [{
+            "role": "user",
+            "content": prompt,
+        }]
+    elif icl_format == 'conversation':
+        return messages
+    elif icl_format == 'prefix':
+        idx = prompt.index(TASK_HEADER) + len(TASK_HEADER)
+        return [
+            {"role": "user", "content": prompt[:idx]},
+            {"role": "assistant", "content": "OK"},
+            {"role": "user", "content": prompt[idx:]},
+        ]
+    raise ValueError(f"Unknown icl_format: {icl_format}")
@@ -1,13 +1,14 @@
-import os
 import json
 import argparse
 
 import numpy as np
-from tqdm import tqdm
+
 from template import ALFWORLD_TEMPLATE, SCIWORLD_TEMPLATE
+from reward_index import load_reward_tensor
+from pair_mining import STRATEGIES, argmax_argmin, mine_pairs
 
 
-def construct_metaplan_pairs(env_type, metaplan_path, sample_dir, output_path, flow_cnt, run_cnt):
+def construct_metaplan_pairs(env_type, metaplan_path, sample_dir, output_path, flow_cnt, run_cnt, num_workers=None, refresh_rewards=False, pairs_dir=None, strategies=("argmax",), allow_missing=False, **mining_options):
     if env_type == "alfworld":
         task_cnt = 3553
         template = ALFWORLD_TEMPLATE
@@ -46,36 +47,16 @@ def construct_metaplan_pairs(env_type, metaplan_path, sample_dir, output_path, f
         raise ValueError(f"Unsupported environment type: {env_type}")
 
     # Calculate success rates
-    all_success_rate = []
-    for flow_idx in range(flow_cnt):
-        success_rate = []
-        for task_idx in tqdm(ids):
-            cur_metric = []
-            for run_idx in range(run_cnt):
-                file_path = os.path.join(sample_dir, f"metaplan-{flow_idx}-run-{run_idx}", f"{task_idx}.json")
-                raw = json.load(open(file_path))
-                cur_metric.append(raw[-1]['reward'])
-            success_rate.append(sum(cur_metric) / len(cur_metric))
-        all_success_rate.append(success_rate)
-
-    all_success_rate = np.array(all_success_rate)
-    max_idx = np.argmax(all_success_rate, axis=0)
-    min_idx = np.argmin(all_success_rate, axis=0)
+    rewards = load_reward_tensor(sample_dir, ids, flow_cnt, run_cnt, num_workers, refresh_rewards, allow_missing)
 
-    # Build preference pairs
-    res = []
-    for idx in range(task_cnt):
-        if max_idx[idx] == min_idx[idx]:
-            continue
-            
+    def make_pair(idx, chosen_flow, rejected_flow, all_success_rate):
         if env_type == "alfworld":
-            task_id = idx
-            chosen_metaplan = metaplans[max_idx[idx]][idx]
-            rejected_metaplan = metaplans[min_idx[idx]][idx]
+            chosen_metaplan = metaplans[chosen_flow][idx]
+            rejected_metaplan = metaplans[rejected_flow][idx]
         else:  # sciworld
             task_id = ids[idx]
-            chosen_metaplan = metaplans[max_idx[idx]][task_id]
-            rejected_metaplan = metaplans[min_idx[idx]][task_id]
+            chosen_metaplan = metaplans[chosen_flow][task_id]
+            rejected_metaplan = metaplans[rejected_flow][task_id]
             
         pair = {
             "conversations": [
@@ -97,16 +78,25 @@ def construct_metaplan_pairs(env_type, metaplan_path, sample_dir, output_path, f
         # For SciWorld, add reward information
         if env_type == "sciworld":
             pair["reward"] = {
-                "chosen": all_success_rate[max_idx[idx]][idx],
-                "rejected": all_success_rate[min_idx[idx]][idx],
+                "chosen": float(all_success_rate[chosen_flow][idx]),
+                "rejected": float(all_success_rate[rejected_flow][idx]),
             }
-            
-        res.append(pair)
+        return pair
+
+    # Build preference pairs
+    all_success_rate = np.nanmean(rewards, axis=1)
+    res = [make_pair(int(idx), int(chosen), int(rejected), all_success_rate)
+           for idx, chosen, rejected, _ in zip(*argmax_argmin(rewards))]
 
     # Save results
     json.dump(res, open(output_path, "w"), indent=4)
     print(f"Results saved to {output_path}")
 
+    if pairs_dir is not None:
+        counts = mine_pairs(rewards, strategies, pairs_dir, make_pair, **mining_options)
+        for strategy, n in counts.items():
+            print(f"{strategy}: {n} pairs saved to {pairs_dir}/{strategy}-*.jsonl")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Construct metaplan preference pairs")
     parser.add_argument("--env", type=str, choices=["alfworld", "sciworld"], required=True,
@@ -121,7 +111,28 @@ if __name__ == "__main__":
                         help="Number of flows")
     parser.add_argument("--run_cnt", type=int, required=True,
                         help="Number of runs")
+    parser.add_argument("--num_workers", type=int, default=None,
+                        help="Processes reading the rewards (default: number of CPUs)")
+    parser.add_argument("--refresh_rewards", action="store_true",
+                        help="Re-read the rewards even if sample_dir has a cached rewards.npy")
+    parser.add_argument("--allow_missing", action="store_true",
+                        help="Leave episodes without a result out of the success rates instead of failing; "
+                             "episodes skipped by mc_orchestrator.py --adaptive are always left out")
+    
+    parser.add_argument("--pairs_dir", type=str, default=None,
+                        help="Also stream the pairs of --strategies to sharded JSONL files in this directory")
+    parser.add_argument("--strategies", type=str, nargs="+", default=["argmax"], choices=list(STRATEGIES),
+                        help="Pair mining strategies written to --pairs_dir")
+    parser.add_argument("--margin", type=float, default=0.0,
+                        help="margin: minimum success-rate gap of a pair")
+    parser.add_argument("--k", type=int, default=2,
+                        help="topk: number of best and worst flows paired per task")
+    parser.add_argument("--min_z", type=float, default=1.0,
+                        help="confidence: minimum gap in standard errors of the MC estimate")
+    parser.add_argument("--shard_size", type=int, default=50000,
+                        help="Pairs per JSONL shard")
     
     args = parser.parse_args()
     
-    construct_metaplan_pairs(args.env, args.metaplan_path, args.sample_dir, args.output_path, args.flow_cnt, args.run_cnt) 
\ No newline at end of file
+    construct_metaplan_pairs(args.env, args.metaplan_path, args.sample_dir, args.output_path, args.flow_cnt, args.run_cnt, args.num_workers, args.refresh_rewards,
+                             args.pairs_dir, args.strategies, allow_missing=args.allow_missing, margin=args.margin, k=args.k, min_z=args.min_z, shard_size=args.shard_size) 
\ No newline at end of file
@@ -2,52 +2,54 @@ import os
 import re
 import json
 import asyncio
-from tqdm.asyncio import tqdm
+import backoff
+from tqdm import tqdm
 from openai import AsyncOpenAI
-from time import sleep
 import argparse
 from template import ALFWORLD_TEMPLATE, SCIWORLD_TEMPLATE
 
 class MetaplanGenerator:
-    def __init__(self, task_type="sciworld", base_url="http://localhost:8001/v1", api_key="EMPTY", model_name="llama3.1-8b", temperature=0):
+    def __init__(self, task_type="sciworld", base_url="http://localhost:8001/v1", api_key="EMPTY", model_name="llama3.1-8b", temperature=0, max_tries=3):
         self.task_type = task_type
         self.base_url = base_url
         self.api_key = api_key
         self.model_name = model_name
         self.template = self._get_template()
         self.temperature = temperature
+        self.max_tries = max_tries
+
     def _get_template(self):
         if self.task_type == "sciworld":
             return SCIWORLD_TEMPLATE
         else:
             return ALFWORLD_TEMPLATE
 
-    async def async_query_openai(self, query, item_id, sample_num=1):
-        n = sample_num
-        aclient = AsyncOpenAI(
-            base_url=self.base_url,
-            api_key=self.api_key,
+    @staticmethod
+    def _give_up(details):
+        print(f"Giving up on {details['args'][2]} after {details['tries']} tries: {details['exception']}")
+
+    async def async_query_openai(self, client, query, item_id, sample_num=1):
+        """Query the model, retrying with jittered exponential backoff. Returns None if every try failed."""
+        query_with_retry = backoff.on_exception(
+            backoff.expo,
+            Exception,
+            max_tries=self.max_tries,
+            max_value=60,
+            jitter=backoff.full_jitter,
+            on_giveup=self._give_up,
+            raise_on_giveup=False,
+        )(self._query)
+        return await query_with_retry(client, query, item_id, sample_num)
+
+    async def _query(self, client, query, item_id, sample_num):
+        completion = await client.chat.completions.create(
+            model=self.model_name,
+            messages=[{"role": "user", "content": query}],
+            max_tokens=512,
+            n=sample_num,
+            temperature=self.temperature,
         )
-        
-        try_times = 3
-        for i in range(try_times):
-            try:
-                completion = await aclient.chat.completions.create(
-                    model=self.model_name,
-                    messages=[{"role": "user", "content": query}],
-                    max_tokens=512,
-                    n=n,
-                    temperature=self.temperature,
-                )
-                res = [completion.choices[i].message.content for i in range(n)]
-                break
-            except Exception as e:
-                print(e)
-                res = "ERROR"
-                if i < try_times-1:
-                    sleep(60)
-        
-        return {"res": res, "id": item_id}
+        return [choice.message.content for choice in completion.choices]
 
     def parse_workflow(self, res):
         try:
@@ -56,7 +58,7 @@ class MetaplanGenerator:
             res_thought = res
         return res_thought
 
-    async def generate_metaplans(self, input_file, output_file, sample_num=1, batch_size=10):
+    async def generate_metaplans(self, input_file, output_file, sample_num=1, concurrency=10):
         # 读取输入数据
         raw = [json.loads(line) for line in open(input_file)]
         
@@ -66,51 +68,71 @@ class MetaplanGenerator:
             for line in open(output_file):
                 item = json.loads(line)
                 done_ids.add(item['id'])
+        todo = [item for item in raw if item["id"] not in done_ids]
+        n_todo = len(todo)
+        todo = iter(enumerate(todo))
 
-        for i in range(0, len(raw), batch_size):
-            batch = raw[i:i+batch_size]
-            new_batch = []
-            queries = []
-            
-            for idx, item in enumerate(batch):
-                item_id = item["id"]
-                if item_id in done_ids:
-                    continue
-                    
-                task = item["task"]
-                new_batch.append((item_id, task))
-                queries.append((self.template.format(task=task), item_id))
-
-            if not queries:
-                continue
-
-            # 执行批量查询
-            tasks = [self.async_query_openai(q, idx) for q, idx in queries]
-            results = []
-            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
-                results.append(await task)
-
-            # 处理结果并写入文件
-            for item_id, task in new_batch:
-                for res in results:
-                    if res['id'] == item_id:
-                        workflows = [self.parse_workflow(r) for r in res['res']]
+        # one client, and so one connection pool, for all requests in flight
+        client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0)
+        running = {}
+        # results that finished ahead of an earlier item, by position in `todo`;
+        # lines are written in input order, as AlfWorld pairs read metaplans by line
+        finished = {}
+        next_pos = 0
+        try:
+            with open(output_file, "a") as fw, tqdm(total=n_todo) as pbar:
+                while True:
+                    # keep `concurrency` requests in flight until the input runs out
+                    for pos, item in todo:
+                        query = self.template.format(task=item["task"])
+                        request = asyncio.ensure_future(
+                            self.async_query_openai(client, query, item["id"], sample_num)
+                        )
+                        running[request] = (pos, item)
+                        if len(running) >= concurrency:
+                            break
+                    if not running:
+                        break
+                    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for request in done:
+                        pos, item = running.pop(request)
+                        pbar.update(1)
+                        finished[pos] = (item, request.result())
+                    while next_pos in finished:
+                        item, res = finished.pop(next_pos)
+                        next_pos += 1
+                        # failed items are not written, so the next run retries them
+                        if res is None:
+                            continue
                         cur = {
-                            "id": item_id,
-                            "task": task,
-                            "workflow": workflows
+                            "id": item["id"],
+                            "task": item["task"],
+                            "workflow": [self.parse_workflow(r) for r in res]
                         }
-                        with open(output_file, "a") as fw:
-                            fw.write(json.dumps(cur) + "\n")
-                        break
+                        fw.write(json.dumps(cur) + "\n")
+                    fw.flush()
+        finally:
+            for request in running:
+                request.cancel()
+            await client.close()
+
+        if done_ids:
+            # items retried on resume were appended after later ones; restore the input order
+            position = {item["id"]: pos for pos, item in enumerate(raw)}
+            lines = sorted(open(output_file), key=lambda line: position.get(json.loads(line)["id"], len(raw)))
+            tmp_file = output_file + ".tmp"
+            with open(tmp_file, "w") as fw:
+                fw.writelines(lines)
+            os.replace(tmp_file, output_file)
 
-async def main(task_type, input_file, output_file, sample_num, base_url, api_key, model_name):
+async def main(task_type, input_file, output_file, sample_num, base_url, api_key, model_name, temperature=0, concurrency=10, max_tries=3):
     # sample metaplans
-    generator = MetaplanGenerator(task_type, base_url, api_key, model_name)
+    generator = MetaplanGenerator(task_type, base_url, api_key, model_name, temperature, max_tries)
     await generator.generate_metaplans(
         input_file,
         output_file,
-        sample_num
+        sample_num,
+        concurrency
     )
 
 if __name__ == "__main__":
@@ -131,5 +153,9 @@ if __name__ == "__main__":
                         help="metaplan generation model name")
     parser.add_argument("--temperature", type=float, required=True, default=0,
                         help="temperature")
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="Number of requests kept in flight")
+    parser.add_argument("--max_tries", type=int, default=3,
+                        help="Tries per request before the item is left for the next run")
     args = parser.parse_args()
-    asyncio.run(main(args.task_type, args.input_file, args.output_file, args.sample_num, args.base_url, args.api_key, args.model_name, args.temperature)) 
\ No newline at end of file
+    asyncio.run(main(args.task_type, args.input_file, args.output_file, args.sample_num, args.base_url, args.api_key, args.model_name, args.temperature, args.concurrency, args.max_tries)) 
\ No newline at end of file
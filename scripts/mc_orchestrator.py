@@ -0,0 +1,353 @@
+import os
+import sys
+import copy
+import json
+import math
+import logging
+import argparse
+from collections import defaultdict, deque
+from statistics import NormalDist
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+# run from the repo root like main.py; the repo packages are imported from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+import envs
+import tasks
+from utils.manifest import RunManifest
+from utils.store import RESULT_BACKENDS
+from utils.tracing import Tracer
+from reward_index import SKIPPED_FILE
+
+logger = logging.getLogger("agent_eval")
+
+
+class MCJob:
+    """One (metaplan flow, run) of the MC grid and its `metaplan-{flow}-run-{run}` output dir."""
+
+    def __init__(self, output_dir, flow_idx, run_idx, results_backend="json", override=False):
+        self.flow_idx = flow_idx
+        self.run_idx = run_idx
+        self.output_path = os.path.join(output_dir, f"metaplan-{flow_idx}-run-{run_idx}")
+        os.makedirs(self.output_path, exist_ok=True)
+        self.manifest = RunManifest(self.output_path, override=override)
+        self.store = RESULT_BACKENDS[results_backend](self.output_path, override=override)
+
+    def add(self, task_id, state):
+        self.store.write(task_id, state)
+        self.manifest.add(task_id, state)
+
+    def close(self):
+        self.store.close()
+
+
+def metaplan_file(metaplan_dir, task_name, flow_idx):
+    """The per-flow metaplans written by split_metaplans_for_sample.py."""
+    return os.path.join(metaplan_dir, f"{task_name}_metaplan_train_sampled_{flow_idx}.jsonl")
+
+
+def make_episodes(all_tasks, workflows, jobs):
+    """A copy of every task per job that has not run it yet, carrying that job's workflow.
+
+    Episodes are ordered task by task, so all flows and runs of a task are
+    in flight together.
+    """
+    for task in all_tasks:
+        for job in jobs:
+            if task.task_id in job.manifest.done_task_ids:
+                continue
+            yield make_episode(task, workflows, job.flow_idx, job.run_idx)
+
+
+def make_episode(task, workflows, flow_idx, run_idx):
+    episode = copy.copy(task)
+    episode.metadata = {"flow": flow_idx, "run": run_idx}
+    episode.workflow = workflows[flow_idx].get(task.workflow_key)
+    return episode
+
+
+class AdaptiveSampler:
+    """Runs, task by task, only the (flow, run) episodes that can still change the mined pair.
+
+    Every flow of a task first gets `min_runs` runs. The task then stops when
+    every run of every flow scored the same, since no pair is made from it.
+    Otherwise the 1 - `delta` credible intervals of each flow's success rate,
+    under a uniform Beta prior, decide which flows may still be the best or
+    the worst one; only those get another run, and the task stops once a
+    single best and a single worst flow remain or `run_cnt` is reached.
+    A distribution-free bound such as Hoeffding's is too wide to separate
+    any two flows within the 5 or so runs per flow the MC grid affords.
+    """
+
+    def __init__(self, all_tasks, workflows, jobs, flow_cnt, run_cnt, min_runs=2, delta=0.05, reward_range=1.0):
+        self.tasks = iter(all_tasks)
+        self.workflows = workflows
+        self.job_of = {(job.flow_idx, job.run_idx): job for job in jobs}
+        self.flow_cnt = flow_cnt
+        self.run_cnt = run_cnt
+        self.min_runs = min(min_runs, run_cnt)
+        self.delta = delta
+        self.reward_range = reward_range
+
+        self.rewards = {}
+        self.active = {}
+        self.rounds = {}
+        self.in_flight = defaultdict(int)
+        self.queue = deque()
+        # grid episodes not run and not already on disk, and the steps of those that ran
+        self.n_skipped = 0
+        self.steps = []
+        # (task_id, flow, run) of the skipped episodes, saved so reward_index.py can tell them from lost ones
+        self.skipped = []
+
+    def next_episode(self):
+        """The next episode to run, or None if every started task waits for results."""
+        while not self.queue:
+            task = next(self.tasks, None)
+            if task is None:
+                return None
+            self._start(task)
+        return self.queue.popleft()
+
+    def finish(self, episode, state):
+        task_id = episode.task_id
+        self.rewards[task_id][episode.metadata["flow"]].append(state.reward or 0.0)
+        self.steps.append(state.steps)
+        self.in_flight[task_id] -= 1
+        if self.in_flight[task_id] == 0:
+            self._decide(episode)
+
+    def _start(self, task):
+        self.rewards[task.task_id] = [[] for _ in range(self.flow_cnt)]
+        self.active[task.task_id] = list(range(self.flow_cnt))
+        self.rounds[task.task_id] = 0
+        for _ in range(self.min_runs):
+            self._schedule_round(task)
+        if self.in_flight[task.task_id] == 0:
+            self._decide(task)
+
+    def _schedule_round(self, task):
+        run_idx = self.rounds[task.task_id]
+        self.rounds[task.task_id] += 1
+        for flow_idx in self.active[task.task_id]:
+            record = self.job_of[flow_idx, run_idx].manifest.records.get(task.task_id)
+            if record is not None:
+                # finished by an earlier, interrupted run
+                self.rewards[task.task_id][flow_idx].append(record["reward"] or 0.0)
+                continue
+            self.in_flight[task.task_id] += 1
+            self.queue.append(make_episode(task, self.workflows, flow_idx, run_idx))
+
+    def _decide(self, task):
+        task_id = task.task_id
+        while self.rounds[task_id] < self.run_cnt:
+            self.active[task_id] = self.contenders(self.rewards[task_id], self.active[task_id])
+            if not self.active[task_id]:
+                break
+            self._schedule_round(task)
+            if self.in_flight[task_id] > 0:
+                return
+
+        for flow_idx, rewards in enumerate(self.rewards[task_id]):
+            for run_idx in range(len(rewards), self.run_cnt):
+                if task_id not in self.job_of[flow_idx, run_idx].manifest.records:
+                    self.n_skipped += 1
+                    self.skipped.append((task_id, flow_idx, run_idx))
+        del self.rewards[task_id], self.active[task_id], self.rounds[task_id], self.in_flight[task_id]
+
+    def contenders(self, rewards, active):
+        """Active flows that may still be the best or the worst; empty once the pair is settled.
+
+        Dropped flows keep their intervals but are not run again.
+        """
+        values = {reward for runs in rewards for reward in runs}
+        if len(values) <= 1:
+            return []
+        lower, upper = zip(*(self.interval(runs) for runs in rewards))
+        best = [f for f in range(self.flow_cnt) if upper[f] >= max(lower)]
+        worst = [f for f in range(self.flow_cnt) if lower[f] <= min(upper)]
+        if len(best) == 1 and len(worst) == 1:
+            return []
+        return sorted((set(best) | set(worst)) & set(active))
+
+    def interval(self, runs):
+        """Normal approximation of the credible interval of the Beta(1 + successes, 1 + failures) posterior.
+
+        Rewards are scaled to [0, 1] by `reward_range` and count as fractional successes.
+        """
+        successes = sum(runs) / self.reward_range
+        a, b = 1 + successes, 1 + len(runs) - successes
+        mean = a / (a + b)
+        std = math.sqrt(a * b / ((a + b) ** 2 * (a + b + 1)))
+        z = NormalDist().inv_cdf(1 - self.delta / 2)
+        return mean - z * std, mean + z * std
+
+
+def save_skipped(output_dir, skipped):
+    with open(os.path.join(output_dir, SKIPPED_FILE), "a") as f:
+        for task_id, flow_idx, run_idx in skipped:
+            f.write(json.dumps({"task_id": task_id, "flow": flow_idx, "run": run_idx}) + "\n")
+
+
+def run_adaptive(sampler, agent_config, env_config, concurrency, env_pool=None):
+    """`main.run_concurrent` over the episodes the sampler hands out as results come in."""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = {}
+        while True:
+            while len(running) < concurrency:
+                episode = sampler.next_episode()
+                if episode is None:
+                    break
+                running[executor.submit(main._run_in_worker, episode, agent_config, env_config, env_pool)] = episode
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                episode = running.pop(future)
+                state = future.result()
+                sampler.finish(episode, state)
+                yield episode, state
+
+
+def run_mc(args, flow_cnt, run_cnt, metaplan_dir, adaptive=False, min_runs=2, delta=0.05, reward_range=1.0):
+    exp_config, agent_config = main.load_configs(args)
+    env_config = exp_config["env_config"]
+    task_config = exp_config["task"]
+    task_class = getattr(tasks, task_config["task_class"])
+
+    # the tasks are loaded once, and so is the AlfWorld game scan, for all jobs
+    all_tasks, n_tasks = task_class.load_tasks(
+        path=task_config.get("filepath", ""),
+        workflow_path=None,
+        split=args.split,
+    )
+    all_tasks = list(all_tasks)
+    if args.debug:
+        all_tasks = all_tasks[:5]
+    workflows = [
+        task_class.load_workflows(metaplan_file(metaplan_dir, task_class.task_name, flow_idx))
+        for flow_idx in range(flow_cnt)
+    ]
+
+    jobs = [
+        MCJob(args.output_dir, flow_idx, run_idx, args.results_backend, args.override)
+        for flow_idx in range(flow_cnt)
+        for run_idx in range(run_cnt)
+    ]
+    job_of = {(job.flow_idx, job.run_idx): job for job in jobs}
+    n_pending = sum(
+        1 for task in all_tasks for job in jobs if task.task_id not in job.manifest.done_task_ids
+    )
+    logger.info(
+        f"{len(jobs)} jobs ({flow_cnt} flows x {run_cnt} runs) over {len(all_tasks)} tasks, "
+        f"{n_pending} episodes to run"
+    )
+
+    env_pool = None
+    if env_config['env_class'] == 'SciWorldEnv':
+        env_pool = envs.SciWorldEnvPool(
+            size=args.env_pool_size or args.concurrency,
+            jar_path=env_config['env_jar_path'],
+            # episodes run task by task, so a server can keep its sub-task
+            affinity=args.task_order == "grouped",
+            lazy_info=not args.eager_sciworld_info,
+        )
+
+    if args.trace or args.chrome_trace:
+        main.tracer = Tracer(
+            os.path.join(args.output_dir, "trace.jsonl") if args.trace else None,
+            os.path.join(args.output_dir, "trace.chrome.json") if args.chrome_trace else None,
+        )
+
+    sampler = None
+    if adaptive:
+        assert not main.is_async_agent(agent_config), "--adaptive needs a synchronous agent"
+        sampler = AdaptiveSampler(all_tasks, workflows, jobs, flow_cnt, run_cnt, min_runs, delta, reward_range)
+        finished = run_adaptive(sampler, agent_config, env_config, args.concurrency, env_pool)
+    elif main.is_async_agent(agent_config):
+        finished = main.run_async(make_episodes(all_tasks, workflows, jobs), agent_config, env_config, args.concurrency, env_pool)
+    else:
+        finished = main.run_concurrent(make_episodes(all_tasks, workflows, jobs), agent_config, env_config, args.concurrency, env_pool)
+
+    successes = defaultdict(list)
+    with logging_redirect_tqdm():
+        pbar = tqdm(total=n_pending, desc="MC episodes")
+        try:
+            for episode, state in finished:
+                flow_idx, run_idx = episode.metadata["flow"], episode.metadata["run"]
+                job_of[flow_idx, run_idx].add(episode.task_id, state)
+                successes[flow_idx].append(state.success)
+                pbar.update(1)
+                if sampler is not None:
+                    # the bar counts down to the episodes still worth running
+                    pbar.total = n_pending - sampler.n_skipped
+                pbar.set_postfix({
+                    f"flow{flow_idx}": f"{sum(done) / len(done):.2f}" for flow_idx, done in sorted(successes.items())
+                })
+        finally:
+            pbar.close()
+            for job in jobs:
+                job.close()
+            main.tracer.close()
+            if sampler is not None:
+                save_skipped(args.output_dir, sampler.skipped)
+            if env_pool is not None:
+                logger.info(env_pool.stats())
+                env_pool.close()
+            main.close_idle_envs()
+
+    for job in jobs:
+        avg_reward, success_rate = job.manifest.metrics()
+        logger.info(f"metaplan-{job.flow_idx}-run-{job.run_idx}: reward {avg_reward}, success rate {success_rate:.4f}")
+    if sampler is not None:
+        steps = sampler.steps or [record["steps"] for job in jobs for record in job.manifest.records.values()]
+        mean_steps = sum(steps) / len(steps) if steps else 0.0
+        logger.info(
+            f"Adaptive sampling skipped {sampler.n_skipped} of {n_pending} episodes, "
+            f"saving about {sampler.n_skipped * mean_steps:.0f} LLM calls ({mean_steps:.1f} steps per episode)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run all (metaplan flow, run) MC jobs in one process. "
+                    "Any other option is passed on to main.py's parser, e.g. --exp_config, --agent_config, "
+                    "--api_base (comma-separated), --concurrency and --output_dir."
+    )
+    parser.add_argument("--metaplan_dir", type=str, required=True,
+                        help="Directory of the {env}_metaplan_train_sampled_{flow}.jsonl files")
+    parser.add_argument("--flow_cnt", type=int, required=True,
+                        help="Number of flows")
+    parser.add_argument("--run_cnt", type=int, required=True,
+                        help="Number of runs")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Stop running the flows of a task once they cannot change its chosen/rejected pair")
+    parser.add_argument("--min_runs", type=int, default=2,
+                        help="adaptive: runs of every flow before a task may stop")
+    parser.add_argument("--delta", type=float, default=0.05,
+                        help="adaptive: flows are told apart by the 1 - delta credible intervals of their success rates")
+    parser.add_argument("--reward_range", type=float, default=1.0,
+                        help="adaptive: range of the episode reward, to scale rewards to success rates")
+    mc_args, main_argv = parser.parse_known_args()
+
+    # the defaults of mc_sample.sh, which the passed options override
+    main_parser = main.build_parser()
+    args = main_parser.parse_args(["--split", "train", "--metaplan_type", "none", *main_argv])
+    if args.batch_size > 1:
+        main_parser.error("--batch_size is not supported by the MC orchestrator, which runs the episodes concurrently")
+    assert args.output_dir is not None, "--output_dir is required"
+    os.makedirs(args.output_dir, exist_ok=True)
+    logging.basicConfig(
+        format="%(message)s",
+        handlers=[logging.StreamHandler(), logging.FileHandler(os.path.join(args.output_dir, "log.txt"), mode='w')],
+    )
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    # the episode loop reads its options from main's module globals
+    main.args = args
+
+    run_mc(args, mc_args.flow_cnt, mc_args.run_cnt, mc_args.metaplan_dir,
+           mc_args.adaptive, mc_args.min_runs, mc_args.delta, mc_args.reward_range)
@@ -63,6 +63,9 @@ for (( i=0; i<$node_num; i=i+1 )); do
     CUDA_VISIBLE_DEVICES=$((start_node+i)) vllm serve $EXPLORER_SAVE_PATH/$EXPLORER_MODEL --port $((start_port+i)) > logs/${TASK_TYPE}_${EXPLORER_MODEL}_${i}.log 2>&1 &
 done
 
+# Every process balances its requests over all servers
+all_base_urls=$(IFS=,; echo "${base_urls[*]}")
+
 # Start task completion agents
 for (( i=0; i<$flow_num; i=i+1 )); do
     for (( j=0; j<$mc_num; j=j+1 )); do
@@ -72,7 +75,7 @@ for (( i=0; i<$flow_num; i=i+1 )); do
             --split train \
             --metaplan_type none \
             --incorporation_type ${INCORPORATION_TYPE} \
-            --api_base ${base_urls[$(((i*mc_num+j)%node_num))]} \
+            --api_base ${all_base_urls} \
             --api_key "EMPTY" \
             --output_dir samples/${TASK_TYPE}_metaplan_mc/metaplan-$i-run-$j &
     done
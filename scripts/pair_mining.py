@@ -0,0 +1,159 @@
+import os
+import json
+import warnings
+
+import numpy as np
+
+
+# Every strategy takes the (flow × run × task) reward array and returns the
+# mined pairs as parallel arrays: task index, chosen flow, rejected flow and a
+# pair weight, ordered by task. Runs that were not sampled are NaN and left out.
+
+
+def _sorted_by_task(task_idx, chosen, rejected, weight):
+    order = np.argsort(task_idx, kind="stable")
+    return task_idx[order], chosen[order], rejected[order], weight[order]
+
+
+def _success_rate(rewards):
+    """The (flow × task) success rates; NaN for a flow without any sampled run."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(rewards, axis=1)
+
+
+def argmax_argmin(rewards):
+    """The best against the worst flow of each task, skipping tasks where all flows tie.
+
+    Flows without a sampled run are left out; a task needs two flows that were.
+    """
+    success_rate = _success_rate(rewards)
+    finite = np.isfinite(success_rate)
+    max_idx = np.argmax(np.where(finite, success_rate, -np.inf), axis=0)
+    min_idx = np.argmin(np.where(finite, success_rate, np.inf), axis=0)
+    tasks = np.arange(success_rate.shape[1])
+    gap = success_rate[max_idx, tasks] - success_rate[min_idx, tasks]
+    task_idx = np.nonzero((finite.sum(axis=0) >= 2) & (gap > 0))[0]
+    return task_idx, max_idx[task_idx], min_idx[task_idx], np.ones(len(task_idx))
+
+
+def margin_pairs(rewards, margin=0.0):
+    """Every ordered pair of flows whose success rates differ by more than `margin`."""
+    success_rate = _success_rate(rewards)
+    finite = np.isfinite(success_rate)
+    diff = success_rate[:, None, :] - success_rate[None, :, :]
+    keep = finite[:, None, :] & finite[None, :, :] & (np.where(np.isnan(diff), -np.inf, diff) > margin)
+    chosen, rejected, task_idx = np.nonzero(keep)
+    return _sorted_by_task(task_idx, chosen, rejected, diff[chosen, rejected, task_idx])
+
+
+def topk_pairs(rewards, k=2):
+    """Each of the k best flows against each of the k worst, where the first is strictly better.
+
+    Only flows with a sampled run are ranked, so a task with fewer than 2k of
+    them pairs its best and worst half instead.
+    """
+    success_rate = _success_rate(rewards)
+    k = min(k, success_rate.shape[0] // 2)
+    # argsort puts NaN last either way, so both orders rank the sampled flows first
+    top = np.argsort(-success_rate, axis=0, kind="stable")[:k]
+    bottom = np.argsort(success_rate, axis=0, kind="stable")[:k]
+    task_k = np.minimum(k, np.isfinite(success_rate).sum(axis=0) // 2)
+    # (k, k, task) grids of every top/bottom combination
+    chosen = np.broadcast_to(top[:, None, :], (k, k, top.shape[1]))
+    rejected = np.broadcast_to(bottom[None, :, :], (k, k, top.shape[1]))
+    task_grid = np.broadcast_to(np.arange(top.shape[1]), chosen.shape)
+    rank = np.arange(k)
+    in_k = (rank[:, None, None] < task_k) & (rank[None, :, None] < task_k)
+    gap = (
+        np.take_along_axis(success_rate, chosen.reshape(k * k, -1), axis=0)
+        - np.take_along_axis(success_rate, rejected.reshape(k * k, -1), axis=0)
+    ).reshape(chosen.shape)
+    keep = in_k & (np.where(np.isnan(gap), -np.inf, gap) > 0)
+    return _sorted_by_task(task_grid[keep], chosen[keep], rejected[keep], gap[keep])
+
+
+def confidence_pairs(rewards, min_z=1.0):
+    """Flow pairs whose success-rate gap is at least `min_z` standard errors of the MC estimate.
+
+    The weight of a pair is its z-score, so pairs backed by consistent runs
+    count for more than ones decided by a single lucky run. Rewards are
+    assumed to lie in [0, 1].
+    """
+    run_cnt = (~np.isnan(rewards)).sum(axis=1)
+    success_rate = _success_rate(rewards)
+    # squared deviations summed with NaN runs left out
+    squares = np.nansum((rewards - success_rate[:, None, :]) ** 2, axis=1)
+    variance = np.where(run_cnt > 1, squares / np.maximum(run_cnt - 1, 1), 0.0)
+    # identical runs (or a single one) have no sample variance, which would make
+    # any gap infinitely certain; use the Laplace-smoothed Bernoulli variance instead
+    smoothed = np.clip((np.nansum(rewards, axis=1) + 1) / (run_cnt + 2), 0.0, 1.0)
+    variance = np.where(variance > 0, variance, smoothed * (1 - smoothed))
+    sq_err = variance / np.maximum(run_cnt, 1)
+    diff = success_rate[:, None, :] - success_rate[None, :, :]
+    stderr = np.sqrt(sq_err[:, None, :] + sq_err[None, :, :])
+    with np.errstate(invalid="ignore"):
+        z = diff / stderr
+        chosen, rejected, task_idx = np.nonzero((diff > 0) & (z >= min_z))
+    return _sorted_by_task(task_idx, chosen, rejected, z[chosen, rejected, task_idx])
+
+
+STRATEGIES = {
+    "argmax": argmax_argmin,
+    "margin": margin_pairs,
+    "topk": topk_pairs,
+    "confidence": confidence_pairs,
+}
+
+
+class ShardedPairWriter:
+    """Appends pairs to `{output_dir}/{strategy}-{idx:05d}.jsonl`, `shard_size` pairs per shard."""
+
+    def __init__(self, output_dir, strategy, shard_size=50000):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.strategy = strategy
+        self.shard_size = shard_size
+        self.shard_idx = 0
+        self.n_pairs = 0
+        self._file = None
+
+    def write(self, pair):
+        if self.n_pairs % self.shard_size == 0:
+            self.close()
+            path = os.path.join(self.output_dir, f"{self.strategy}-{self.shard_idx:05d}.jsonl")
+            self._file = open(path, "w")
+            self.shard_idx += 1
+        self._file.write(json.dumps(pair) + "\n")
+        self.n_pairs += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def mine_pairs(rewards, strategies, output_dir, make_pair, shard_size=50000, **options):
+    """Run each strategy over `rewards` and stream its pairs to sharded JSONL.
+
+    `make_pair(task_idx, chosen, rejected, success_rate)` turns one mined pair
+    into its output record; `options` are passed to the strategies that take
+    them (`margin`, `k`, `min_z`). Returns the number of pairs per strategy.
+    """
+    success_rate = _success_rate(rewards)
+    counts = {}
+    for strategy in strategies:
+        fn = STRATEGIES[strategy]
+        kwargs = {
+            name: value for name, value in options.items()
+            if name in fn.__code__.co_varnames[:fn.__code__.co_argcount]
+        }
+        writer = ShardedPairWriter(output_dir, strategy, shard_size)
+        for task_idx, chosen, rejected, weight in zip(*fn(rewards, **kwargs)):
+            pair = make_pair(int(task_idx), int(chosen), int(rejected), success_rate)
+            pair["strategy"] = strategy
+            pair["weight"] = float(weight)
+            writer.write(pair)
+        writer.close()
+        counts[strategy] = writer.n_pairs
+    return counts
@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import argparse
+from itertools import combinations
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt import prompt_with_icl, initial_history
+from utils.tokenizer import load_tokenizer, chat_token_ids
+
+
+def common_prefix_len(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def shared_prefix_tokens(tokenizer, instruction, raw_icl, tasks, icl_format, icl_num=1):
+    """Return (average prompt tokens, tokens shared by every pair of tasks)."""
+    token_ids = []
+    for task in tasks:
+        prompt, messages = prompt_with_icl(instruction, raw_icl, task, icl_num=icl_num)
+        token_ids.append(chat_token_ids(tokenizer, initial_history(prompt, messages, icl_format)))
+    shared = min(common_prefix_len(a, b) for a, b in combinations(token_ids, 2))
+    return sum(len(ids) for ids in token_ids) / len(token_ids), shared
+
+
+def main(env, tokenizer_name, icl_formats, tasks_file=None, num_tasks=8):
+    tokenizer = load_tokenizer(tokenizer_name)
+    instruction = open(f"prompt/instructions/{env}_inst.txt").read()
+    raw_icl = json.load(open(f"prompt/icl_examples/{env}_icl.json"))
+
+    if env == "alfworld":
+        groups = {task_type: examples for task_type, examples in raw_icl.items()}
+    else:
+        groups = {"all": raw_icl}
+
+    if tasks_file is not None:
+        with open(tasks_file) as fr:
+            tasks = [json.loads(line)["task"] for line in fr.readlines()[:num_tasks]]
+    else:
+        # the first user turn of every ICL example is a realistic task description
+        tasks = [example[0]["content"] for examples in groups.values() for example in examples]
+    assert len(tasks) >= 2, "At least two tasks are needed, pass --tasks_file"
+
+    print(f"{'task_type':<24}{'icl_format':<14}{'prompt_tokens':>14}{'shared_tokens':>14}{'shared':>8}")
+    for task_type, examples in groups.items():
+        for icl_format in icl_formats:
+            n_tokens, shared = shared_prefix_tokens(tokenizer, instruction, examples, tasks, icl_format)
+            print(f"{task_type:<24}{icl_format:<14}{n_tokens:>14.0f}{shared:>14}{shared / n_tokens:>8.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report how many prompt tokens are shared across tasks")
+    parser.add_argument("--env", type=str, choices=["alfworld", "sciworld"], required=True,
+                        help="Environment type: alfworld or sciworld")
+    parser.add_argument("--tokenizer", type=str, required=True,
+                        help="Tokenizer name or path, e.g. the served model path")
+    parser.add_argument("--icl_formats", type=str, nargs="+", default=["first", "conversation", "prefix"],
+                        help="Prompt layouts to compare")
+    parser.add_argument("--tasks_file", type=str, required=False,
+                        help="JSONL file with a 'task' field per line, e.g. data/sciworld/sciworld_train_tasks.jsonl. "
+                             "Defaults to the tasks of the ICL examples.")
+    parser.add_argument("--num_tasks", type=int, default=8,
+                        help="Number of tasks to read from --tasks_file")
+    args = parser.parse_args()
+
+    main(args.env, args.tokenizer, args.icl_formats, args.tasks_file, args.num_tasks)
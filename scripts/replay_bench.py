@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import json
+import logging
+import argparse
+from collections import defaultdict
+
+from tqdm import tqdm
+
+# run from the repo root like main.py; the repo packages are imported from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+import envs
+import tasks
+from utils.datatypes import State
+from utils.manifest import RESULT_FILE
+from utils.store import ShardedJsonlStore
+from summarize_trace import percentile
+
+logger = logging.getLogger("agent_eval")
+
+
+def load_trajectories(replay_dir, results_backend="json"):
+    """Saved trajectories of a run dir, by task id as a string."""
+    if results_backend == "jsonl.zst":
+        return {str(task_id): State.load_json(trajectory)
+                for task_id, trajectory in ShardedJsonlStore.iter_trajectories(replay_dir)}
+    trajectories = {}
+    for file_name in os.listdir(replay_dir):
+        match = RESULT_FILE.fullmatch(file_name)
+        if match is None:
+            continue
+        with open(os.path.join(replay_dir, file_name)) as f:
+            trajectories[match.group(1)] = State.load_json(json.load(f))
+    return trajectories
+
+
+def same_reward(recorded, replayed):
+    if recorded is None or replayed is None:
+        return recorded is None and replayed is None
+    return abs(float(recorded) - float(replayed)) < 1e-6
+
+
+def action_type(action):
+    return action.split()[0] if action else "<invalid>"
+
+
+def replay_episode(task, recorded, env_config, seen_envs):
+    """Reset the env into `task` and step it with the assistant outputs of `recorded`.
+
+    Returns the replayed state, the reset latency, the env setup time and the
+    wall time of each `env.step` by action type. An env is built once and
+    reused like in main.py: on its first episode the simulator is loaded
+    while building it, so only the setup time is set; afterwards `reset`
+    reloads the simulator and only the reset latency is set.
+    """
+    start = time.perf_counter()
+    env = main.acquire_env(task, env_config)
+    setup_time = time.perf_counter() - start
+    first_use = id(env) not in seen_envs
+    seen_envs.add(id(env))
+    try:
+        env.args = main.args
+        env.trace = main.start_trace(task)
+        start = time.perf_counter()
+        _, state = env.reset(task)
+        reset_time = time.perf_counter() - start
+        # the first messages are the prompt and the ICL examples, the same on every reset
+        outputs = [message["content"] for message in recorded.history[len(state.history):] if message["role"] == "assistant"]
+        step_times = []
+        for llm_output in outputs:
+            if state.finished:
+                break
+            start = time.perf_counter()
+            _, state = env.step(llm_output)
+            step_times.append(time.perf_counter() - start)
+    finally:
+        main.release_env(env, env_config)
+        task.close()
+    by_type = defaultdict(list)
+    for record, step_time in zip(state.records, step_times):
+        by_type[action_type(record.action)].append(step_time)
+    if first_use:
+        return state, None, setup_time + reset_time, by_type
+    return state, reset_time, None, by_type
+
+
+def run_replay(all_tasks, trajectories, env_config, env_pool=None, limit=None):
+    mismatches = []
+    reset_times = []
+    setup_times = []
+    step_times = defaultdict(list)
+    seen_envs = set()
+    n_episodes = 0
+    pbar = tqdm(total=min(len(trajectories), limit or len(trajectories)), desc="Replaying")
+    try:
+        for task in all_tasks:
+            if limit is not None and n_episodes >= limit:
+                break
+            recorded = trajectories.get(str(task.task_id))
+            if recorded is None:
+                continue
+            if env_pool is None:
+                state, reset_time, setup_time, by_type = replay_episode(task, recorded, env_config, seen_envs)
+            else:
+                with env_pool.lease(getattr(task, "sub_task_name", None)) as server:
+                    state, reset_time, setup_time, by_type = replay_episode(
+                        task, recorded, {**env_config, "env": server}, seen_envs
+                    )
+            if not same_reward(recorded.reward, state.reward):
+                mismatches.append({"task_id": task.task_id, "recorded": recorded.reward, "replayed": state.reward})
+                logger.warning(f"Task {task.task_id}: recorded reward {recorded.reward}, replayed {state.reward}")
+            if reset_time is not None:
+                reset_times.append(reset_time)
+            if setup_time is not None:
+                setup_times.append(setup_time)
+            for name, durs in by_type.items():
+                step_times[name].extend(durs)
+            n_episodes += 1
+            pbar.update(1)
+    finally:
+        pbar.close()
+        main.close_idle_envs()
+    return n_episodes, reset_times, setup_times, step_times, mismatches
+
+
+def report(n_episodes, reset_times, setup_times, step_times, mismatches):
+    all_steps = [dur for durs in step_times.values() for dur in durs]
+    step_total = sum(all_steps)
+    summary = {
+        "episodes": n_episodes,
+        "steps": len(all_steps),
+        "steps_per_sec": len(all_steps) / step_total if step_total else 0.0,
+        "reset_ms": {
+            "mean": sum(reset_times) / len(reset_times) * 1e3,
+            "p50": percentile(reset_times, 50) * 1e3,
+            "p95": percentile(reset_times, 95) * 1e3,
+        } if reset_times else None,
+        "env_setup_ms": [setup_time * 1e3 for setup_time in setup_times],
+        "actions": {
+            name: {
+                "count": len(durs),
+                "mean_ms": sum(durs) / len(durs) * 1e3,
+                "p50_ms": percentile(durs, 50) * 1e3,
+                "p95_ms": percentile(durs, 95) * 1e3,
+            }
+            for name, durs in sorted(step_times.items())
+        },
+        "reward_mismatches": mismatches,
+    }
+
+    print(f"{n_episodes} episodes, {len(all_steps)} steps, {summary['steps_per_sec']:.1f} steps/s")
+    if reset_times:
+        print(f"reset: mean {summary['reset_ms']['mean']:.1f} ms, p50 {summary['reset_ms']['p50']:.1f} ms, p95 {summary['reset_ms']['p95']:.1f} ms")
+    if setup_times:
+        print(f"env setup (first episode of an env, not counted as a reset): {sum(setup_times) * 1e3:.1f} ms")
+    print()
+    print(f"{'action':<16}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, stats in summary["actions"].items():
+        print(f"{name:<16}{stats['count']:>8}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}")
+    print()
+    print(f"{len(mismatches)} of {n_episodes} episodes replayed to a different reward")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay the saved trajectories of a run dir through the env without an agent. "
+                    "Reports env throughput and latency, and checks that the rewards match. "
+                    "Any other option is passed on to main.py's parser, e.g. --exp_config, --split and "
+                    "--action_match_threshold (pass the one of the recorded run)."
+    )
+    parser.add_argument("--replay_dir", type=str, required=True,
+                        help="Output dir of the run to replay")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="Replay at most this many episodes")
+    parser.add_argument("--report_path", type=str, default=None,
+                        help="Also save the report as JSON here")
+    replay_args, main_argv = parser.parse_known_args()
+
+    args = main.build_parser().parse_args(["--metaplan_type", "none", *main_argv])
+    logging.basicConfig(format="%(message)s")
+    logger.setLevel(logging.DEBUG if args.debug else logging.WARNING)
+    # the env reads its options from main's module globals
+    main.args = args
+
+    # no agent is needed, so only the experiment config is read
+    with open(os.path.join(args.exp_path, f"{args.exp_config}.json")) as f:
+        exp_config = json.load(f)
+    env_config = exp_config["env_config"]
+    task_config = exp_config["task"]
+    task_class = getattr(tasks, task_config["task_class"])
+    all_tasks, _ = task_class.load_tasks(
+        path=task_config.get("filepath", ""),
+        split=args.split,
+        part_num=args.part_num,
+        part_idx=args.part_idx,
+    )
+    trajectories = load_trajectories(replay_args.replay_dir, args.results_backend)
+
+    env_pool = None
+    if env_config["env_class"] == "SciWorldEnv":
+        # one server, kept on the loaded sub-task while consecutive tasks share it
+        env_pool = envs.SciWorldEnvPool(
+            size=1, jar_path=env_config["env_jar_path"], affinity=True, lazy_info=not args.eager_sciworld_info
+        )
+    try:
+        results = run_replay(all_tasks, trajectories, env_config, env_pool, replay_args.limit)
+    finally:
+        if env_pool is not None:
+            env_pool.close()
+
+    summary = report(*results)
+    if replay_args.report_path is not None:
+        with open(replay_args.report_path, "w") as f:
+            json.dump(summary, f, indent=4)
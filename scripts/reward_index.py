@@ -0,0 +1,136 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+
+# start of the trailer record in a trajectory saved by main.py (`json.dump(..., indent=4)`);
+# message contents are JSON strings, so a raw newline can never occur inside them
+TRAILER_START = b'\n    {\n        "steps": '
+TAIL_BYTES = 4096
+# the (task, flow, run) cells that mc_orchestrator.py --adaptive decided not to run
+SKIPPED_FILE = "skipped.jsonl"
+
+
+def read_trailer(file_path):
+    """Read the trailing info record of a trajectory file without parsing its history."""
+    with open(file_path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        n = TAIL_BYTES
+        while True:
+            f.seek(max(size - n, 0))
+            tail = f.read()
+            idx = tail.rfind(TRAILER_START)
+            if idx != -1:
+                # drop the closing `]` of the list
+                return json.loads(tail[idx:].rstrip()[:-1])
+            if n >= size:
+                # not written by main.py, parse the whole file
+                return json.loads(tail)[-1]
+            n *= 4
+
+
+def read_reward(file_path):
+    # NaN for an episode without a file; build_reward_tensor checks that it was skipped
+    if not os.path.exists(file_path):
+        return np.nan
+    return read_trailer(file_path)["reward"]
+
+
+def read_run_rewards(run_dir, ids):
+    """Rewards of one `metaplan-{flow}-run-{run}` dir in the order of `ids`, NaN where an episode was not run."""
+    manifest_path = os.path.join(run_dir, "manifest.jsonl")
+    if os.path.exists(manifest_path):
+        rewards = {}
+        for line in open(manifest_path):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            rewards[str(record["task_id"])] = record["reward"]
+        # a manifest of an unfinished run falls back to the files it is missing
+        return [
+            rewards[str(task_id)] if str(task_id) in rewards
+            else read_reward(os.path.join(run_dir, f"{task_id}.json"))
+            for task_id in ids
+        ]
+    return [read_reward(os.path.join(run_dir, f"{task_id}.json")) for task_id in ids]
+
+
+def read_skipped(sample_dir):
+    """The (task_id, flow, run) cells the adaptive sampler skipped, task ids as strings."""
+    path = os.path.join(sample_dir, SKIPPED_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {(str(cell["task_id"]), cell["flow"], cell["run"]) for cell in map(json.loads, f)}
+
+
+def build_reward_tensor(sample_dir, ids, flow_cnt, run_cnt, num_workers=None):
+    """Read the reward of every (flow, run, task) into an array of that shape, NaN where there is no result."""
+    runs = [(flow_idx, run_idx) for flow_idx in range(flow_cnt) for run_idx in range(run_cnt)]
+    rewards = np.empty((flow_cnt, run_cnt, len(ids)), dtype=np.float64)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(
+                read_run_rewards, os.path.join(sample_dir, f"metaplan-{flow_idx}-run-{run_idx}"), ids
+            ): (flow_idx, run_idx)
+            for flow_idx, run_idx in runs
+        }
+        for future in tqdm(futures, desc="Reading rewards"):
+            flow_idx, run_idx = futures[future]
+            rewards[flow_idx, run_idx] = future.result()
+
+    return rewards
+
+
+def check_missing(rewards, sample_dir, ids, allow_missing=False):
+    """Make sure every NaN cell of `rewards` was skipped by adaptive sampling.
+
+    Any other episode without a result, e.g. from a crashed run, raises
+    unless `allow_missing` is set, in which case it is only reported.
+    """
+    skipped = read_skipped(sample_dir)
+    missing = [
+        (flow_idx, run_idx, ids[task_idx])
+        for flow_idx, run_idx, task_idx in zip(*np.nonzero(np.isnan(rewards)))
+        if (str(ids[task_idx]), flow_idx, run_idx) not in skipped
+    ]
+    n_skipped = int(np.isnan(rewards).sum()) - len(missing)
+    if n_skipped:
+        print(f"{n_skipped} of {rewards.size} episodes were skipped by adaptive sampling and are left out of the success rates")
+    if missing:
+        examples = ", ".join(f"metaplan-{f}-run-{r}/{task_id}" for f, r, task_id in missing[:5])
+        message = f"{len(missing)} of {rewards.size} episodes have no result and were not skipped by adaptive sampling (e.g. {examples})"
+        if not allow_missing:
+            raise FileNotFoundError(f"{message}; rerun them, or pass --allow_missing to leave them out")
+        print(f"WARNING: {message}; they are left out of the success rates")
+
+
+def load_reward_tensor(sample_dir, ids, flow_cnt, run_cnt, num_workers=None, refresh=False, allow_missing=False):
+    """The (flow × run × task) reward array, cached as `rewards.npy` in `sample_dir`.
+
+    Episodes skipped by adaptive sampling, and with `allow_missing` any other
+    episode without a result, are NaN.
+    The cache is rebuilt when its shape or task ids do not match the request,
+    or when `refresh` is set (e.g. after re-running some episodes).
+    """
+    cache_path = os.path.join(sample_dir, "rewards.npy")
+    ids_path = os.path.join(sample_dir, "rewards.ids.json")
+    ids = list(ids)
+    if not refresh and os.path.exists(cache_path) and os.path.exists(ids_path):
+        rewards = np.load(cache_path)
+        if rewards.shape == (flow_cnt, run_cnt, len(ids)) and json.load(open(ids_path)) == ids:
+            print(f"Loaded cached rewards from {cache_path}")
+            check_missing(rewards, sample_dir, ids, allow_missing)
+            return rewards
+
+    rewards = build_reward_tensor(sample_dir, ids, flow_cnt, run_cnt, num_workers)
+    np.save(cache_path, rewards)
+    json.dump(ids, open(ids_path, "w"))
+    print(f"Cached rewards to {cache_path}")
+    check_missing(rewards, sample_dir, ids, allow_missing)
+    return rewards
+
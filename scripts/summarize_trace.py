@@ -0,0 +1,55 @@
+import json
+import argparse
+from collections import defaultdict
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a non-empty list."""
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))
+    return values[idx]
+
+
+def summarize(trace_path):
+    spans = defaultdict(lambda: defaultdict(list))
+    episodes = defaultdict(list)
+    with open(trace_path) as fr:
+        for line in fr:
+            record = json.loads(line)
+            if record["type"] == "span":
+                spans[record["task_type"]][record["name"]].append(record["dur"])
+            elif record["type"] == "episode":
+                episodes[record["task_type"]].append(record)
+
+    print(f"{'task_type':<28}{'span':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'total s':>10}")
+    for task_type in sorted(spans, key=str):
+        for name, durs in sorted(spans[task_type].items()):
+            print(
+                f"{str(task_type):<28}{name:<12}{len(durs):>8}"
+                f"{percentile(durs, 50) * 1e3:>10.1f}{percentile(durs, 95) * 1e3:>10.1f}"
+                f"{percentile(durs, 99) * 1e3:>10.1f}{sum(durs):>10.1f}"
+            )
+
+    print()
+    print(f"{'task_type':<28}{'episodes':>9}{'steps':>8}{'wall s':>9}{'agent':>8}{'env':>8}{'parse':>8}{'harness':>9}{'tok/s':>9}")
+    for task_type in sorted(episodes, key=str):
+        records = episodes[task_type]
+        wall = sum(r["wall"] for r in records)
+        share = lambda key: sum(r.get(key, 0.0) for r in records) / wall if wall else 0.0
+        agent_time = sum(r.get("agent_time", 0.0) for r in records)
+        completion_tokens = sum(r.get("completion_tokens", 0) for r in records)
+        print(
+            f"{str(task_type):<28}{len(records):>9}{sum(r['steps'] for r in records) / len(records):>8.1f}"
+            f"{wall / len(records):>9.1f}{share('agent_time'):>8.1%}"
+            f"{share('env_step_time') + share('reset_time'):>8.1%}{share('parse_time'):>8.1%}"
+            f"{share('harness_time'):>9.1%}{completion_tokens / agent_time if agent_time else 0.0:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a trace.jsonl written by main.py --trace")
+    parser.add_argument("--trace_path", type=str, required=True,
+                        help="Path to trace.jsonl")
+    args = parser.parse_args()
+
+    summarize(args.trace_path)
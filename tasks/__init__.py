@@ -1,3 +1,3 @@
 from .base import Task
 from .alfworld import AlfWorldTask
-from .sciworld import SciWorldTask
\ No newline at end of file
+from .sciworld import SciWorldTask, count_sub_task_switches, group_by_sub_task
\ No newline at end of file
@@ -2,12 +2,15 @@ import os
 import json
 import yaml
 import logging
-from typing import Iterable, Tuple
+from typing import Any, Dict, Iterable, List, Tuple
 
-import alfworld
-import alfworld.agents.environment as envs
+import alfworld.agents.environment
+import textworld
+import textworld.gym
+from alfworld.agents.environment.alfred_tw_env import AlfredDemangler, AlfredInfos
 
 from tasks.base import Task
+from utils.workflow_store import WorkflowStore
 
 
 logger = logging.getLogger("agent_eval")
@@ -21,6 +24,112 @@ PREFIXES = {
     "pick_two_obj": "puttwo",
 }
 
+# Split following ReAct
+# https://github.com/ysymyth/ReAct/blob/master/alfworld.ipynb
+SPLITS = {
+    "train": ("train", 3553),
+    "dev": ("eval_in_distribution", 140),
+    "test": ("eval_out_of_distribution", 134),
+}
+
+
+def make_game_env(config: Dict[str, Any], train_eval: str, game_files: List[str], batch_size: int = 1):
+    """`AlfredTWEnv.init_env` for the given games, without scanning the data dir for them.
+
+    The expert-plan wrapper that `init_env` adds for DAgger training is left
+    out, as the agents never read the expert plan.
+    """
+    domain_randomization = config["env"]["domain_randomization"] and train_eval == "train"
+    wrappers = [AlfredDemangler(shuffle=domain_randomization), AlfredInfos]
+    request_infos = textworld.EnvInfos(won=True, admissible_commands=True, extras=["gamefile"])
+    if config["general"]["training_method"] == "dqn":
+        max_nb_steps_per_episode = config["rl"]["training"]["max_nb_steps_per_episode"]
+    else:
+        max_nb_steps_per_episode = config["dagger"]["training"]["max_nb_steps_per_episode"]
+    env_id = textworld.gym.register_games(
+        game_files,
+        request_infos,
+        batch_size=batch_size,
+        asynchronous=True,
+        max_episode_steps=max_nb_steps_per_episode,
+        wrappers=wrappers,
+    )
+    return textworld.gym.make(env_id)
+
+
+def load_game(env, game_file: str) -> None:
+    """Point a single-game env from `make_game_env` at another game; its next `reset` loads it.
+
+    `reset` closes the current game and loads the next one from the env's
+    game list, so the env and its wrappers are reused.
+    """
+    env.gamefiles = [game_file]
+    # rebuilds the game iterator that `reset` draws from
+    env.seed(1234)
+
+
+def manifest_path(path: str, split: str) -> str:
+    return os.path.join(path, f"task_manifest_{split}.jsonl")
+
+
+def build_manifest(path: str, split: str) -> List[Dict[str, Any]]:
+    """Walk all games of a split once and save game file, cleaned observation and task type per task.
+
+    The order is the order in which `AlfredTWEnv` resets into the games, which
+    defines the task ids.
+    """
+    os.environ["ALFWORLD_DATA"] = path
+    with open(os.path.join(path, "base_config.yaml")) as f:
+        config = yaml.safe_load(f)
+    train_eval, n_tasks = SPLITS[split]
+
+    alfred_env = getattr(alfworld.agents.environment, config["env"]["type"])(
+        config, train_eval=train_eval
+    )
+    assert isinstance(alfred_env, alfworld.agents.environment.AlfredTWEnv)
+    env = alfred_env.init_env(batch_size=1)
+
+    entries = []
+    for idx in range(n_tasks):
+        obs, info = env.reset()
+        obs = "\n".join(obs[0].split("\n\n")[1:])
+        game_file = info["extra.gamefile"][0]
+        name = "/".join(game_file.split("/")[-3:-1])
+
+        task_type = None
+        for _, (k, v) in enumerate(PREFIXES.items()):
+            if name.startswith(k):
+                task_type = k
+                break
+        assert task_type is not None, f"Task type not found for {name}"
+
+        entries.append({
+            "task_id": idx,
+            "task_name": name,
+            "task_type": task_type,
+            "game_file": os.path.relpath(game_file, path),
+            "obs": obs,
+        })
+    env.close()
+
+    # written under a temporary name, so runs started together never read a partial manifest
+    tmp_path = f"{manifest_path(path, split)}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    os.replace(tmp_path, manifest_path(path, split))
+    logger.info(f"Saved the {split} task manifest to {manifest_path(path, split)}")
+    return entries
+
+
+def load_manifest(path: str, split: str) -> List[Dict[str, Any]]:
+    """The task manifest of a split, built on first use."""
+    if not os.path.exists(manifest_path(path, split)):
+        logger.info(f"No {split} task manifest in {path}, scanning the games once to build it")
+        return build_manifest(path, split)
+    with open(manifest_path(path, split)) as f:
+        return [json.loads(line) for line in f]
+
 
 class AlfWorldTask(Task):
     """Alfworld task instance."""
@@ -30,10 +139,14 @@ class AlfWorldTask(Task):
     def __init__(
         self,
         task_name: str,
-        env: envs.AlfredTWEnv,
         task_type: str,
         obs: str,
+        game_file: str,
+        config: Dict[str, Any],
+        train_eval: str,
+        env=None,
         workflow: str = None,
+        admissible_commands: List[str] = None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -42,9 +155,85 @@ class AlfWorldTask(Task):
         self.observation = obs
         self.workflow = workflow
 
-        self.env = env
+        self.game_file = game_file
+        self.config = config
+        self.train_eval = train_eval
+        self._env = env
+        # set by `detach`; the env of a batched wave belongs to its runner
+        self._owns_env = False
+        # admissible commands at the start of the game, from the reset that loaded it
+        self.admissible_commands = admissible_commands
+
+    @property
+    def env(self):
+        """The env this task is played in, loaded with only its game on first use."""
+        if self._env is None:
+            self.detach()
+        return self._env
+
+    @property
+    def workflow_key(self) -> str:
+        return self.observation
+
+    @staticmethod
+    def load_workflows(workflow_path: str) -> WorkflowStore:
+        """Workflows of a metaplan file, looked up by the task observation."""
+        return WorkflowStore.shared(workflow_path, "task")
+
+    @property
+    def loaded(self) -> bool:
+        return self._env is not None
+
+    def detach(self, env=None) -> None:
+        """Give the task a dedicated env loaded with this game.
+
+        Tasks of a batch share the batched env of their wave until then.
+        `env` is the single-game env of a finished task, which is reloaded
+        with this game instead of building a new one.
+        """
+        if env is None:
+            env = make_game_env(self.config, self.train_eval, [self.game_file], batch_size=1)
+        else:
+            load_game(env, self.game_file)
+        _, info = env.reset()
+        self.admissible_commands = info["admissible_commands"][0]
+        self._env = env
+        self._owns_env = True
+
+    def take_env(self):
+        """Hand over the env `detach` created, e.g. to reload it with the next task; None for a wave env."""
+        if not self._owns_env:
+            return None
+        env, self._env, self._owns_env = self._env, None, False
+        return env
+
+    def close(self) -> None:
+        """Shut down the game process of the env `detach` created."""
+        if self._owns_env and self._env is not None:
+            self._env.close()
+            self._env = None
+            self._owns_env = False
+
+    @classmethod
+    def load_wave(cls, wave: List["AlfWorldTask"], batch_size: int) -> List["AlfWorldTask"]:
+        """Load the games of `wave` into one batched env with `batch_size` slots.
+
+        Returns the tasks listed by slot, since the env may load the games in
+        another order. The tasks share the env until they are detached.
+        """
+        task0 = wave[0]
+        by_game_file = {task.game_file: task for task in wave}
+        env = make_game_env(task0.config, task0.train_eval, list(by_game_file), batch_size)
+        _, info = env.reset()
+        slot_tasks = []
+        for slot, game_file in enumerate(info["extra.gamefile"][:len(wave)]):
+            task = by_game_file[game_file]
+            task._env = env
+            task._owns_env = False
+            task.admissible_commands = info["admissible_commands"][slot]
+            slot_tasks.append(task)
+        return slot_tasks
 
-    
     @classmethod
     def load_tasks(
         cls, 
@@ -54,76 +243,55 @@ class AlfWorldTask(Task):
         part_num: int = 1,
         part_idx: int = -1,
     ) -> Tuple[Iterable[Task], int]:
-        """Load alfworld data and prompts from a directory."""
+        """Load alfworld tasks from the task manifest of the split.
+
+        No game is loaded until a task's env is first used, or until
+        `load_wave` puts the task into a batched env.
+        """
         os.environ["ALFWORLD_DATA"] = path
 
         with open(os.path.join(path, "base_config.yaml")) as f:
             config = yaml.safe_load(f)
+        train_eval, N_TASKS = SPLITS[split]
+        entries = load_manifest(path, split)
 
-        # Split following ReAct
-        # https://github.com/ysymyth/ReAct/blob/master/alfworld.ipynb
-        if split == 'train':
-            split = "train"
-            N_TASKS = 3553
-        elif split == 'dev':
-            split = "eval_in_distribution"
-            N_TASKS = 140
-        elif split == 'test':
-            split = "eval_out_of_distribution"
-            N_TASKS = 134
-
-        env = getattr(alfworld.agents.environment, config["env"]["type"])(
-            config, train_eval=split
-        )
-        assert isinstance(env, alfworld.agents.environment.AlfredTWEnv)
-        env = env.init_env(batch_size=1)
-
-        if workflow_path is not None:
-            with open(workflow_path) as fr:
-                raw_workflows = fr.readlines()
-                workflows = [json.loads(w) for w in raw_workflows]
-        else:
-            workflows = [None] * N_TASKS
+        workflows = cls.load_workflows(workflow_path) if workflow_path is not None else {}
 
         if part_num > 1:
             assert part_idx != -1
             part_inst_num = [N_TASKS // part_num] * part_num
             part_inst_num[-1] += N_TASKS % part_num
-            # jump to the start of the part
-            env.skip(sum(part_inst_num[:part_idx]))
-            workflows = workflows[sum(part_inst_num[:part_idx]):sum(part_inst_num[:part_idx+1])]
+            start = sum(part_inst_num[:part_idx])
+            entries = entries[start:start + part_inst_num[part_idx]]
             N_TASKS = part_inst_num[part_idx]
-            
-        obs_2_workflow = {}
-        for item in workflows:
-            if item is None:
-                continue
-            obs = item['task']
-            workflow = item['workflow']
-            obs_2_workflow[obs] = workflow
+
+        def build_task(entry):
+            return cls(
+                task_id=entry["task_id"],
+                task_name=entry["task_name"],
+                task_type=entry["task_type"],
+                obs=entry["obs"],
+                game_file=os.path.join(path, entry["game_file"]),
+                config=config,
+                train_eval=train_eval,
+                workflow=workflows.get(entry["obs"], None),
+            )
 
         def generator():
-            for idx in range(N_TASKS):
-                obs, info = env.reset()
-                obs = "\n".join(obs[0].split("\n\n")[1:])
-                game_file = info["extra.gamefile"][0]
-                
-                name = "/".join(game_file.split("/")[-3:-1])
-
-                task_type = None
-                for _, (k, v) in enumerate(PREFIXES.items()):
-                    if name.startswith(k):
-                        task_type = k
-                        break
-                assert task_type is not None, f"Task type not found for {name}"
-
-                yield cls(
-                    task_id=idx,
-                    task_name=name,
-                    env=env,
-                    task_type=task_type,
-                    obs=obs,
-                    workflow=obs_2_workflow.get(obs, None),
-                )
+            for entry in entries:
+                yield build_task(entry)
 
         return generator(), N_TASKS
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the AlfWorld task manifest of a split")
+    parser.add_argument("--path", type=str, default="data/alfworld", help="AlfWorld data dir")
+    parser.add_argument("--split", type=str, choices=list(SPLITS), required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    entries = build_manifest(args.path, args.split)
+    print(f"{len(entries)} tasks saved to {manifest_path(args.path, args.split)}")
@@ -3,6 +3,8 @@ import logging
 from abc import ABC
 from typing import Any, List, Tuple
 
+from utils.workflow_store import WorkflowStore
+
 logger = logging.getLogger("agent_eval")
 
 
@@ -14,7 +16,27 @@ class Task(ABC):
     def __init__(self, **kwargs) -> None:
         self.task_id: Any = kwargs.get("task_id", None)
         self.metadata = {}
-        
+
+    def detach(self) -> None:
+        """Give the task its own simulator state so it can run alongside
+        other tasks. Tasks that do not share state need nothing here."""
+        pass
+
+    def close(self) -> None:
+        """Release what `detach` or the first use of the task started, once
+        its episode is over."""
+        pass
+
+    @property
+    def workflow_key(self) -> Any:
+        """The key of this task in the dict returned by `load_workflows`."""
+        return self.task_id
+
+    @staticmethod
+    def load_workflows(workflow_path: str) -> WorkflowStore:
+        """Workflows of a metaplan file, looked up by task id."""
+        return WorkflowStore.shared(workflow_path, "id")
+
     @classmethod
     def load_tasks(cls, path: str) -> Tuple[List["Task"], int]:
         """Load all the tasks from a given jsonl file."""
@@ -40,12 +40,7 @@ class SciWorldTask(Task):
             raise ValueError
         taskname2id = json.load(open("data/sciworld/taskname2id.json"))
 
-        if workflow_path is not None:
-            with open(workflow_path, "r") as fr:
-                raw_workflows = fr.readlines()
-                workflows = [json.loads(w) for w in raw_workflows]
-        else:
-            workflows = [None] * len(task_idxs)
+        workflows = cls.load_workflows(workflow_path) if workflow_path is not None else {}
 
 
         if part_num == 1:
@@ -54,17 +49,8 @@ class SciWorldTask(Task):
             assert part_idx != -1
             part_len = len(task_idxs) // part_num + 1
             task_idxs = task_idxs[part_len * part_idx: part_len * (part_idx + 1)]
-            workflows = workflows[part_len * part_idx: part_len * (part_idx + 1)]
         N_TASKS = len(task_idxs)
 
-        task_id_2_workflow = {}
-        for item in workflows:
-            if item is None:
-                continue
-            task_id = item['id']
-            workflow = item["workflow"]
-            task_id_2_workflow[task_id] = workflow
-
         
         def generator():
             for item in task_idxs:
@@ -74,8 +60,25 @@ class SciWorldTask(Task):
                     task_id=f"{taskname2id[task_name]}_{variation_idx}",
                     sub_task_name=task_name,
                     variation_idx=variation_idx,
-                    workflow=task_id_2_workflow.get(f"{taskname2id[task_name]}_{variation_idx}", None),
+                    workflow=workflows.get(f"{taskname2id[task_name]}_{variation_idx}", None),
                 )
                     
         return generator(), N_TASKS
-    
\ No newline at end of file
+    
+
+
+def group_by_sub_task(tasks: Iterable[SciWorldTask]) -> List[SciWorldTask]:
+    """Order tasks so that those of one sub-task are adjacent.
+
+    Sub-tasks keep the order in which they first appear, and tasks keep
+    their order within a sub-task.
+    """
+    groups = {}
+    for task in tasks:
+        groups.setdefault(task.sub_task_name, []).append(task)
+    return [task for group in groups.values() for task in group]
+
+
+def count_sub_task_switches(tasks: List[SciWorldTask]) -> int:
+    """How often consecutive tasks belong to different sub-tasks."""
+    return sum(prev.sub_task_name != task.sub_task_name for prev, task in zip(tasks, tasks[1:]))
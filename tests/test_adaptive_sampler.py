@@ -0,0 +1,58 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "scripts")]
+
+from mc_orchestrator import AdaptiveSampler
+from tasks.base import Task
+from utils.datatypes import State
+
+
+class FakeManifest:
+    def __init__(self):
+        self.records = {}
+
+
+class FakeJob:
+    def __init__(self, flow_idx, run_idx):
+        self.flow_idx = flow_idx
+        self.run_idx = run_idx
+        self.manifest = FakeManifest()
+
+
+def run_sampler(reward_of_flow, flow_cnt, run_cnt, min_runs=2):
+    jobs = [FakeJob(flow_idx, run_idx) for flow_idx in range(flow_cnt) for run_idx in range(run_cnt)]
+    workflows = [{} for _ in range(flow_cnt)]
+    sampler = AdaptiveSampler([Task(task_id=0)], workflows, jobs, flow_cnt, run_cnt, min_runs)
+    runs = [0] * flow_cnt
+    while True:
+        episode = sampler.next_episode()
+        if episode is None:
+            return sampler, runs
+        flow_idx = episode.metadata["flow"]
+        runs[flow_idx] += 1
+        state = State()
+        state.reward = reward_of_flow(flow_idx, episode.metadata["run"])
+        sampler.finish(episode, state)
+
+
+def test_separated_flows_stop_early():
+    # one flow always succeeds and the other always fails
+    sampler, runs = run_sampler(lambda flow_idx, run_idx: float(flow_idx == 0), flow_cnt=2, run_cnt=8)
+    assert runs == [4, 4]
+    assert sampler.n_skipped == 8
+    assert sorted(sampler.skipped) == [(0, flow_idx, run_idx) for flow_idx in range(2) for run_idx in range(4, 8)]
+
+
+def test_tied_rewards_stop_after_min_runs():
+    sampler, runs = run_sampler(lambda flow_idx, run_idx: 1.0, flow_cnt=3, run_cnt=5)
+    assert runs == [2, 2, 2]
+    assert sampler.n_skipped == 9
+
+
+def test_overlapping_flows_run_the_full_budget():
+    # both flows succeed on alternating runs, so neither can be told apart
+    sampler, runs = run_sampler(lambda flow_idx, run_idx: float((flow_idx + run_idx) % 2), flow_cnt=2, run_cnt=5)
+    assert runs == [5, 5]
+    assert sampler.n_skipped == 0
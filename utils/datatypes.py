@@ -1,16 +1,45 @@
 import enum
-from copy import deepcopy
 from dataclasses import dataclass
 from typing import List, Dict, Any, Optional, Tuple
 from collections import defaultdict
 
 
+class StepRecord:
+    """What happened in one step of an episode.
+
+    `action` is None when no action could be parsed from the agent output;
+    `rewrite` holds the parsed action and match confidence when the action
+    matcher replaced it with an admissible command. Timings are in seconds
+    and token counts are None when the backend does not report them.
+    """
+
+    __slots__ = (
+        "action", "rewrite", "observation", "reward",
+        "agent_time", "env_time", "prompt_tokens", "completion_tokens",
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    # the observation is already in the history, so it is not saved twice
+    serialized = tuple(name for name in __slots__ if name != "observation")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.serialized}
+
+
 class State:
     """This should contains everything needed to continue the conversation.
 
     For example, the history of the conversation, the current task (success/failure) at each step, etc.
     """
 
+    __slots__ = (
+        "history", "reward", "finished", "success", "terminate_reason",
+        "error", "steps", "error_step", "context", "records",
+    )
+
     def __init__(
         self,
         reward: float = None,
@@ -26,6 +55,8 @@ class State:
             {"role": "assistant", "content": "The Los Angeles Dodgers won the World Series in 2020."},
             {"role": "user", "content": "Where was it played?"}
         ]
+        Messages are only ever appended, never modified, so they can be
+        shared with the serialized output.
         """
         self.history: List[Dict[str, Any]] = []
         self.reward: float = reward
@@ -34,6 +65,10 @@ class State:
         self.terminate_reason: str = terminate_reason
         self.error: Optional[str] = None
         self.steps = 0
+        self.error_step = 0
+        # what the context window cut from the prompts, if it had to
+        self.context: Optional[Dict[str, Any]] = None
+        self.records: List[StepRecord] = []
 
     @classmethod
     def load_json(cls, json_dict: Dict[str, Any]):
@@ -46,20 +81,36 @@ class State:
         state.terminate_reason = info["terminate_reason"]
         state.error = info["error"]
         state.steps = info["steps"]
+        state.context = info.get("context")
+        state.records = [StepRecord(**record) for record in info.get("records", [])]
         return state
 
     @property
     def empty(self):
         return len(self.history) == 0
 
-    def to_dict(self) -> Dict[str, Any]:
-        history = deepcopy(self.history)
-        history.append({
+    def step_record(self) -> StepRecord:
+        """The record of the step in progress, created on first access."""
+        while len(self.records) <= self.steps:
+            self.records.append(StepRecord())
+        return self.records[self.steps]
+
+    def info(self) -> Dict[str, Any]:
+        """The trailer record that follows the history in the saved format."""
+        info = {
             "steps": self.steps,
             "reward": self.reward,
             "finished": self.finished,
             "success": self.success,
             "terminate_reason": self.terminate_reason,
             "error": self.error,
-        })
-        return history
+        }
+        if self.context is not None:
+            info["context"] = self.context
+        if self.records:
+            info["records"] = [record.to_dict() for record in self.records]
+        return info
+
+    def to_dict(self) -> List[Dict[str, Any]]:
+        """History followed by the trailer; the messages are shared, not copied."""
+        return [*self.history, self.info()]
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, Optional, Set, Tuple
+
+from utils.datatypes import State
+
+
+logger = logging.getLogger("agent_eval")
+
+# `{task_id}.json` result files: AlfWorld ids are indices, SciWorld ids `{task}_{variation}`
+RESULT_FILE = re.compile(r"(\d+(?:_\d+)?)\.json")
+
+
+class RunManifest:
+    """Append-only record of the tasks finished in an output directory.
+
+    One JSON line per task with the fields needed for resuming and for the
+    final metrics, so neither has to parse the trajectory files.
+    """
+
+    filename = "manifest.jsonl"
+
+    def __init__(self, output_path: str, override: bool = False):
+        self.output_path = output_path
+        self.path = os.path.join(output_path, self.filename)
+        self.records: Dict[Any, Dict[str, Any]] = {}
+
+        if override:
+            open(self.path, "w").close()
+        elif os.path.exists(self.path):
+            self._load()
+        else:
+            self._migrate()
+
+    @staticmethod
+    def make_record(task_id: Any, state: State) -> Dict[str, Any]:
+        return {
+            "task_id": task_id,
+            "reward": state.reward,
+            "success": state.success,
+            "steps": state.steps,
+            "terminate_reason": state.terminate_reason,
+        }
+
+    def _load(self) -> None:
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by an interrupted run; the task is rerun
+                    continue
+                self.records[record["task_id"]] = record
+
+    def _migrate(self) -> None:
+        """Build the manifest once from result files written before it existed."""
+        for file in os.listdir(self.output_path):
+            # other JSON files in the dir, e.g. trace.chrome.json, are not results
+            match = RESULT_FILE.fullmatch(file)
+            if match is None:
+                continue
+            task_id = match.group(1)
+            task_id = int(task_id) if task_id.isdigit() else task_id
+            state = State.load_json(json.load(open(os.path.join(self.output_path, file))))
+            self.records[task_id] = self.make_record(task_id, state)
+        if self.records:
+            logger.info(f"Built {self.filename} from {len(self.records)} existing result files.")
+        with open(self.path, "w") as f:
+            for record in self.records.values():
+                f.write(json.dumps(record) + "\n")
+
+    def add(self, task_id: Any, state: State) -> None:
+        record = self.make_record(task_id, state)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.records[task_id] = record
+
+    @property
+    def done_task_ids(self) -> Set[Any]:
+        return set(self.records)
+
+    def metrics(self) -> Tuple[Optional[float], float]:
+        """Return (average reward, success rate) over all recorded tasks."""
+        reward_list = []
+        success_list = []
+        for record in self.records.values():
+            if record["reward"] is not None:
+                reward_list.append(record["reward"])
+            success_list.append(record["success"])
+
+        avg_reward = sum(reward_list) / len(success_list) if len(reward_list) != 0 else None
+        return avg_reward, sum(success_list) / len(success_list)
@@ -1,7 +1,35 @@
+import types
+from collections.abc import Mapping
+from typing import Any, Callable, Dict
+
 from scienceworld import ScienceWorldEnv
 
 
-def step(self, inputStr:str):
+class LazyInfo(Mapping):
+    """The info dict of a step whose expensive fields are fetched on first access.
+
+    Each thunk runs at most once and its value is kept. The thunks query the
+    server, so they must be read before the next step to describe this one.
+    """
+
+    def __init__(self, values: Dict[str, Any], thunks: Dict[str, Callable[[], Any]]):
+        self._values = values
+        self._thunks = thunks
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._values:
+            self._values[key] = self._thunks.pop(key)()
+        return self._values[key]
+
+    def __iter__(self):
+        yield from self._values
+        yield from list(self._thunks)
+
+    def __len__(self) -> int:
+        return len(self._values) + len(self._thunks)
+
+
+def step(self, inputStr:str, lazy: bool = False):
     observation = self.server.step(inputStr)
     raw_score = self.server.getScore()
     score = int(round(100 * raw_score))        # Convert from 0-1 to 0-100
@@ -22,6 +50,27 @@ def step(self, inputStr:str):
         isCompleted = True
 
     # Mirror of Jericho API
+    if lazy:
+        # each of these is a round trip to the server, `getValidActionObjectCombinations` a slow one
+        infos = LazyInfo(
+            {
+                'moves': numMoves,
+                'raw_score': raw_score,
+                'score': score,
+                'reward': reward,
+                'variationIdx': self.variationIdx,
+                'taskName': self.taskName,
+                'simplificationStr': self.simplificationStr,
+            },
+            {
+                'look': self.look,
+                'inv': self.inventory,
+                'taskDesc': self.taskdescription,
+                'valid': self.getValidActionObjectCombinations,
+            },
+        )
+        return observation, reward, isCompleted, infos
+
     infos = {
         'moves': numMoves,
         'raw_score': raw_score,
@@ -39,6 +88,20 @@ def step(self, inputStr:str):
     return observation, reward, isCompleted, infos
 
 
-def sciworld_monkey_patch():
-    ScienceWorldEnv.step = step
+def lazy_step(self, inputStr:str):
+    return step(self, inputStr, lazy=True)
+
+
+def sciworld_monkey_patch(env: ScienceWorldEnv = None, lazy: bool = True):
+    """Patch `step` on the ScienceWorldEnv class, or only on `env` when given.
+
+    With `lazy`, the look, inventory, task description and valid actions in
+    the info of a step are only fetched when read; `lazy=False` fetches them
+    on every step.
+    """
+    patched_step = lazy_step if lazy else step
+    if env is not None:
+        env.step = types.MethodType(patched_step, env)
+        return
+    ScienceWorldEnv.step = patched_step
     print("Monkey Patched ScienceWorldEnv.step")
@@ -0,0 +1,167 @@
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+from typing import Any, Dict, Iterator, List, Tuple
+
+from prompt import TASK_HEADER
+from utils.datatypes import State
+
+
+logger = logging.getLogger("agent_eval")
+
+
+class JsonDirStore:
+    """One indented JSON file per task, named after the task id."""
+
+    def __init__(self, output_path: str, **kwargs):
+        self.output_path = output_path
+
+    def write(self, task_id: Any, state: State) -> None:
+        json.dump(state.to_dict(), open(os.path.join(self.output_path, f"{task_id}.json"), 'w'), indent=4)
+
+    def close(self) -> None:
+        pass
+
+
+class ShardedJsonlStore:
+    """Appends trajectories to zstd-compressed JSONL shards.
+
+    The instruction and ICL examples that open the first message are the same
+    for every task, so each distinct prefix is written once per shard and
+    trajectories refer to it by hash. Every record is its own zstd frame, so a
+    shard stays readable up to the last complete record if a run is killed.
+    A new shard is started on every run and after `shard_size` records;
+    with `override` the shards of earlier runs are deleted first.
+    """
+
+    suffix = ".jsonl.zst"
+
+    def __init__(self, output_path: str, shard_size: int = 1000, level: int = 10, override: bool = False, **kwargs):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("The jsonl.zst results backend requires `pip install zstandard`.")
+        self.output_path = output_path
+        self.shard_size = shard_size
+        if override:
+            for path in self.shard_paths(output_path):
+                os.remove(path)
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.shard_idx = len(self.shard_paths(output_path))
+        self._file = None
+        self._n_records = 0
+        self._prefixes = set()
+
+    @classmethod
+    def shard_paths(cls, output_path: str) -> List[str]:
+        return sorted(
+            os.path.join(output_path, file)
+            for file in os.listdir(output_path)
+            if file.startswith("trajectories-") and file.endswith(cls.suffix)
+        )
+
+    @staticmethod
+    def split_prefix(content: str) -> Tuple[str, str]:
+        """Split the first message into the shared prefix and the task-specific rest."""
+        idx = content.find(TASK_HEADER)
+        if idx == -1:
+            return content, ""
+        idx += len(TASK_HEADER)
+        return content[:idx], content[idx:]
+
+    def _open_shard(self) -> None:
+        path = os.path.join(self.output_path, f"trajectories-{self.shard_idx:05d}{self.suffix}")
+        self._file = open(path, "ab")
+        self._n_records = 0
+        self._prefixes = set()
+        self.shard_idx += 1
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        self._file.write(self.compressor.compress(line))
+
+    def write(self, task_id: Any, state: State) -> None:
+        if self._file is None or self._n_records >= self.shard_size:
+            self.close()
+            self._open_shard()
+
+        history = list(state.history)
+        prefix_hash = None
+        if history:
+            prefix, rest = self.split_prefix(history[0]["content"])
+            prefix_hash = hashlib.sha1(prefix.encode("utf-8")).hexdigest()
+            if prefix_hash not in self._prefixes:
+                self._append({"type": "prefix", "hash": prefix_hash, "text": prefix})
+                self._prefixes.add(prefix_hash)
+            history[0] = {**history[0], "content": rest}
+
+        self._append({
+            "type": "trajectory",
+            "task_id": task_id,
+            "prefix": prefix_hash,
+            "history": history,
+            "info": state.info(),
+        })
+        self._file.flush()
+        self._n_records += 1
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @classmethod
+    def iter_trajectories(cls, output_path: str) -> Iterator[Tuple[Any, List[Dict[str, Any]]]]:
+        """Yield (task_id, history + trailer) in the per-task JSON layout."""
+        import zstandard
+
+        decompressor = zstandard.ZstdDecompressor()
+        for path in cls.shard_paths(output_path):
+            prefixes = {}
+            with open(path, "rb") as f:
+                reader = io.TextIOWrapper(
+                    decompressor.stream_reader(f, read_across_frames=True), encoding="utf-8"
+                )
+                try:
+                    for line in reader:
+                        record = json.loads(line)
+                        if record["type"] == "prefix":
+                            prefixes[record["hash"]] = record["text"]
+                            continue
+                        history = record["history"]
+                        if record["prefix"] is not None:
+                            history[0]["content"] = prefixes[record["prefix"]] + history[0]["content"]
+                        yield record["task_id"], history + [record["info"]]
+                except (zstandard.ZstdError, json.JSONDecodeError):
+                    logger.warning(f"{path} ends with a truncated record, skipping it")
+
+
+def export_json(input_dir: str, output_dir: str) -> int:
+    """Write the trajectories of a sharded store back as one JSON file per task."""
+    os.makedirs(output_dir, exist_ok=True)
+    n = 0
+    for task_id, trajectory in ShardedJsonlStore.iter_trajectories(input_dir):
+        json.dump(trajectory, open(os.path.join(output_dir, f"{task_id}.json"), 'w'), indent=4)
+        n += 1
+    return n
+
+
+RESULT_BACKENDS = {
+    "json": JsonDirStore,
+    "jsonl.zst": ShardedJsonlStore,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a jsonl.zst result store to per-task JSON files")
+    parser.add_argument("--input_dir", type=str, required=True,
+                        help="Output dir written with --results_backend jsonl.zst")
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="Directory to write the {task_id}.json files to")
+    args = parser.parse_args()
+
+    n = export_json(args.input_dir, args.output_dir)
+    print(f"Exported {n} trajectories to {args.output_dir}")
@@ -0,0 +1,33 @@
+import functools
+from typing import Callable, Dict, List
+
+
+# loading a tokenizer takes seconds, so every caller shares one instance per name
+@functools.lru_cache(maxsize=8)
+def load_tokenizer(name_or_path: str):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name_or_path)
+
+
+def chat_token_ids(tokenizer, messages: List[Dict[str, str]]) -> List[int]:
+    """Token ids of `messages` as the server renders them for generation."""
+    return tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)
+
+
+@functools.lru_cache(maxsize=8)
+def token_counter(name_or_path: str) -> Callable[[str], int]:
+    """Return a function counting the tokens of a string for the given model.
+
+    Uses the HuggingFace tokenizer of local or hub models and falls back to
+    tiktoken for API models such as gpt-4o.
+    """
+    try:
+        tokenizer = load_tokenizer(name_or_path)
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    except Exception:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(name_or_path)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text))
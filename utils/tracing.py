@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+
+class Tracer:
+    """Writes timing spans of the interactive loop to a JSONL file.
+
+    Each line is either a `span` (agent call, action parse, env step, ...) or
+    the `episode` summary emitted when a task finishes. When `chrome_path` is
+    given, the spans are also saved in Chrome trace format on `close()`, which
+    can be opened in chrome://tracing or Perfetto. A tracer without paths
+    discards everything.
+    """
+
+    def __init__(self, path: Optional[str] = None, chrome_path: Optional[str] = None):
+        self.path = path
+        self.chrome_path = chrome_path
+        self._file = open(path, "a", buffering=1) if path else None
+        self._events = []
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None or self.chrome_path is not None
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        line = json.dumps(record)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+            if self.chrome_path is not None and record["type"] == "span":
+                self._events.append({
+                    "name": record["name"],
+                    "ph": "X",
+                    "ts": record["start"] * 1e6,
+                    "dur": record["dur"] * 1e6,
+                    "pid": 0,
+                    "tid": record["tid"],
+                    "args": {k: v for k, v in record.items() if k not in ("type", "name", "start", "dur", "tid")},
+                })
+
+    def episode(self, **context) -> "EpisodeTrace":
+        return EpisodeTrace(self, **context)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.chrome_path is not None:
+            with open(self.chrome_path, "w") as f:
+                json.dump({"traceEvents": self._events}, f)
+
+
+class EpisodeTrace:
+    """Spans of one episode, tagged with its task id and task type."""
+
+    def __init__(self, tracer: Tracer, **context):
+        self.tracer = tracer
+        self.context = context
+        self.totals = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str, **fields) -> Iterator[Dict[str, Any]]:
+        """Time the block; the yielded dict can be filled with extra fields."""
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.add(name, start, time.perf_counter() - start, **fields)
+
+    def add(self, name: str, start: float, dur: float, **fields) -> None:
+        """Record a span timed by the caller, e.g. one batched step shared by several episodes."""
+        self.totals[name] += dur
+        for key in ("prompt_tokens", "completion_tokens"):
+            if fields.get(key) is not None:
+                self.counters[key] += fields[key]
+        self.tracer.emit({
+            "type": "span",
+            "name": name,
+            "start": start - self.tracer._t0,
+            "dur": dur,
+            "tid": threading.get_ident(),
+            **self.context,
+            **fields,
+        })
+
+    def finish(self, state) -> None:
+        wall = time.perf_counter() - self.start
+        self.tracer.emit({
+            "type": "episode",
+            **self.context,
+            "steps": state.steps,
+            "success": state.success,
+            "reward": state.reward,
+            "terminate_reason": state.terminate_reason,
+            "wall": wall,
+            **{f"{name}_time": total for name, total in self.totals.items()},
+            # time not spent in any span: prompt building, logging, scheduling
+            "harness_time": wall - sum(self.totals.values()),
+            **self.counters,
+        })
+
+
+NULL_TRACER = Tracer()
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+
+INDEX_DTYPE = np.dtype([("hash", "<u8"), ("offset", "<u8"), ("length", "<u4")])
+
+
+def key_hash(key: Any) -> int:
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class WorkflowStore:
+    """Read-only lookup of the workflows in a metaplan JSONL file.
+
+    A sorted index of (hash of `key_field`, byte offset, length) per line is
+    built once next to the file as `{path}.{key_field}.idx.npy`. Both the
+    index and the JSONL are memory-mapped, so processes reading the same file
+    share its pages, and only the lines that are looked up get parsed.
+    Duplicate keys resolve to the last line, as in a dict built from the file.
+    """
+
+    _shared: Dict[Tuple[str, str], "WorkflowStore"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path: str, key_field: str = "id"):
+        self.path = path
+        self.key_field = key_field
+        self.index_path = f"{path}.{key_field}.idx.npy"
+        if not os.path.exists(self.index_path) or os.path.getmtime(self.index_path) < os.path.getmtime(path):
+            self.build_index()
+        self.index = np.load(self.index_path, mmap_mode="r")
+        self.hashes = self.index["hash"]
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    @classmethod
+    def shared(cls, path: str, key_field: str = "id") -> "WorkflowStore":
+        """One store per file and key in this process."""
+        key = (os.path.abspath(path), key_field)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(path, key_field)
+            return cls._shared[key]
+
+    def build_index(self) -> None:
+        entries = []
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    entries.append((key_hash(json.loads(line)[self.key_field]), offset, len(line)))
+                offset += len(line)
+        index = np.array(entries, dtype=INDEX_DTYPE)
+        # stable, so lines with the same hash stay in file order
+        index = index[np.argsort(index["hash"], kind="stable")]
+        # written under a temporary name, so concurrent workers never map a partial index
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, index)
+        os.replace(tmp_path, self.index_path)
+
+    def get_item(self, key: Any) -> Optional[Dict[str, Any]]:
+        h = key_hash(key)
+        lo = np.searchsorted(self.hashes, h, side="left")
+        hi = np.searchsorted(self.hashes, h, side="right")
+        for i in range(hi - 1, lo - 1, -1):
+            offset, length = int(self.index[i]["offset"]), int(self.index[i]["length"])
+            item = json.loads(self.data[offset:offset + length])
+            if str(item[self.key_field]) == str(key):
+                return item
+        return None
+
+    def get(self, key: Any, default: Optional[str] = None) -> Optional[str]:
+        item = self.get_item(key)
+        return item["workflow"] if item is not None else default
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get_item(key) is not None
+
+    def __len__(self) -> int:
+        return len(self.index)